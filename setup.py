@@ -9,10 +9,14 @@ setup(name='tap-looker',
       classifiers=['Programming Language :: Python :: 3 :: Only'],
       py_modules=['tap_looker'],
       install_requires=[
-          'backoff==1.8.0',
           'requests==2.22.0',
           'singer-python==5.8.1'
       ],
+      extras_require={
+          'orjson': [
+              'orjson>=3.0'
+          ]
+      },
       entry_points='''
           [console_scripts]
           tap-looker=tap_looker:main
@@ -5,7 +5,7 @@ import json
 import argparse
 import singer
 from singer import metadata, utils
-from tap_looker.client import LookerClient
+from tap_looker.client import LookerClient, POOL_SIZE_DEFAULT
 from tap_looker.discover import discover
 from tap_looker.sync import sync
 
@@ -32,13 +32,34 @@ def main():
 
     parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
 
+    # Connection pool: one connection per child response in flight (2 per sync worker thread,
+    #   streamed responses hold their connection until read), plus the main thread
+    pool_size = parsed_args.config.get('connection_pool_size')
+    if not pool_size:
+        pool_size = max(
+            POOL_SIZE_DEFAULT,
+            2 * int(parsed_args.config.get('max_workers', 1)) + 1,
+            int(parsed_args.config.get('query_window_workers', 1)) + 1)
+
     with LookerClient(subdomain=parsed_args.config['subdomain'],
                       client_id=parsed_args.config['client_id'],
                       client_secret=parsed_args.config['client_secret'],
                       domain=parsed_args.config['domain'],
                       api_port=parsed_args.config['api_port'],
                       api_version=parsed_args.config['api_version'],
-                      user_agent=parsed_args.config['user_agent']) as client:
+                      user_agent=parsed_args.config['user_agent'],
+                      requests_per_second=parsed_args.config.get('requests_per_second'),
+                      requests_burst=parsed_args.config.get('requests_burst'),
+                      http_cache_path=parsed_args.config.get('http_cache_path'),
+                      http_cache_max_mb=parsed_args.config.get('http_cache_max_mb'),
+                      connect_timeout=parsed_args.config.get('connect_timeout'),
+                      request_timeout=parsed_args.config.get('request_timeout'),
+                      retry_max_tries=parsed_args.config.get('retry_max_tries'),
+                      retry_max_time=parsed_args.config.get('retry_max_time'),
+                      retry_factor=parsed_args.config.get('retry_factor'),
+                      retry_max_wait=parsed_args.config.get('retry_max_wait'),
+                      pool_size=pool_size,
+                      compression=parsed_args.config.get('compression', True)) as client:
 
         state = {}
         if parsed_args.state:
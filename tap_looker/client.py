@@ -1,6 +1,15 @@
+import codecs
+from collections import Counter
 from datetime import datetime, timedelta
-import backoff
+from email.utils import parsedate_to_datetime
+import json as json_lib
+import os
+import random
+import sqlite3
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import singer
 from singer import metrics
 
@@ -10,6 +19,16 @@ API_DOMAIN_DEFAULT = 'looker.com'
 API_PORT_DEFAULT = '19999'
 API_VERSIONS_SUPPORTED = ['2.99', '3.0', '3.1']
 API_VERSION_DEFAULT = '3.1'
+HTTP_CACHE_MAX_MB_DEFAULT = 500
+RATE_LIMIT_PAUSE_MAX = 60
+STREAM_CHUNK_SIZE = 64 * 1024
+CONNECT_TIMEOUT_DEFAULT = 30 # seconds
+REQUEST_TIMEOUT_DEFAULT = 300 # seconds, between bytes received
+RETRY_MAX_TRIES_DEFAULT = 7
+RETRY_MAX_TIME_DEFAULT = 900 # seconds
+RETRY_FACTOR_DEFAULT = 3 # seconds
+RETRY_MAX_WAIT_DEFAULT = 120 # seconds
+POOL_SIZE_DEFAULT = 10 # connections
 
 
 class Server5xxError(Exception):
@@ -18,6 +37,231 @@ class Server5xxError(Exception):
 class Server429Error(Exception):
     pass
 
+RETRY_EXCEPTIONS = (
+    Server5xxError,
+    Server429Error,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError)
+
+# Persistent (SQLite file) cache of GET response bodies with their validators (ETag and
+#   Last-Modified), keyed by URL, kept between runs. Cached responses are revalidated with
+#   conditional requests (If-None-Match / If-Modified-Since); a 304 response is served from
+#   the file. Responses without validators are not stored.
+#   Bounded by the total size of the cached bodies; least recently used bodies are evicted.
+class HttpCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, ' \
+            'last_modified TEXT, body BLOB, size INTEGER, accessed REAL)')
+        self.__connection.commit()
+        self.__size = self.__connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # Returns (etag, last_modified, body) or None
+    def get(self, url):
+        with self.__lock:
+            return self.__connection.execute(
+                'SELECT etag, last_modified, body FROM responses WHERE url = ?',
+                (url,)).fetchone()
+
+    # Revalidated (HTTP 304)
+    def touch(self, url):
+        with self.__lock:
+            self.hits = self.hits + 1
+            self.__connection.execute(
+                'UPDATE responses SET accessed = ? WHERE url = ?', (time.time(), url))
+            self.__connection.commit()
+
+    def put(self, url, etag, last_modified, body):
+        with self.__lock:
+            self.misses = self.misses + 1
+            row = self.__connection.execute(
+                'SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            if row:
+                self.__connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self.__size = self.__size - row[0]
+            if (etag or last_modified) and len(body) <= self.max_bytes:
+                self.__connection.execute(
+                    'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (url, etag, last_modified, sqlite3.Binary(body), len(body), time.time()))
+                self.__size = self.__size + len(body)
+            # Evict least recently used bodies
+            while self.__size > self.max_bytes:
+                evicted_url, evicted_size = self.__connection.execute(
+                    'SELECT url, size FROM responses ORDER BY accessed LIMIT 1').fetchone()
+                self.__connection.execute(
+                    'DELETE FROM responses WHERE url = ?', (evicted_url,))
+                self.__size = self.__size - evicted_size
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+# Client-side token bucket rate limiter, shared by all threads using the client.
+#   rate: requests per second (None = unlimited); burst: bucket size (max. back-to-back requests)
+#   A 429 response pauses ALL requests for the Retry-After seconds (or an increasing pause,
+#   if the header is missing), instead of each thread backing off on its own.
+class RateLimiter:
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        if burst:
+            self.burst = burst
+        else:
+            self.burst = max(1, rate or 1)
+        self.__tokens = self.burst
+        self.__updated = time.monotonic()
+        self.__paused_until = 0
+        self.__throttled_count = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                if now < self.__paused_until:
+                    wait = self.__paused_until - now
+                elif not self.rate:
+                    return
+                else:
+                    # Refill the bucket
+                    self.__tokens = min(
+                        self.burst,
+                        self.__tokens + (now - self.__updated) * self.rate)
+                    self.__updated = now
+                    if self.__tokens >= 1:
+                        self.__tokens = self.__tokens - 1
+                        return
+                    wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self.__lock:
+            self.__throttled_count = self.__throttled_count + 1
+            if retry_after is None:
+                retry_after = min(2 ** self.__throttled_count, RATE_LIMIT_PAUSE_MAX)
+            now = time.monotonic()
+            self.__paused_until = max(self.__paused_until, now + retry_after)
+            self.__tokens = 0
+            self.__updated = self.__paused_until
+        LOGGER.warning('Rate limit exceeded (HTTP 429), pausing requests for {} seconds'.format(
+            retry_after))
+
+    def succeeded(self):
+        self.__throttled_count = 0
+
+
+# Retry policy for API requests: exponential backoff with full jitter, a random wait between
+#   0 and factor * 2 ** (tries - 1) seconds (at most max_wait), or the Retry-After seconds.
+#   Gives up after max_tries tries, or when the retry would start more than max_time seconds
+#   after the first try.
+class RetryPolicy:
+    def __init__(self,
+                 max_tries=RETRY_MAX_TRIES_DEFAULT,
+                 max_time=RETRY_MAX_TIME_DEFAULT,
+                 factor=RETRY_FACTOR_DEFAULT,
+                 max_wait=RETRY_MAX_WAIT_DEFAULT):
+        self.max_tries = max_tries
+        self.max_time = max_time
+        self.factor = factor
+        self.max_wait = max_wait
+
+    def get_wait(self, tries, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_wait, self.factor * 2 ** (tries - 1)))
+
+    def should_retry(self, tries, started, wait):
+        return tries < self.max_tries and time.monotonic() + wait - started <= self.max_time
+
+
+# Retry-After header: delay-seconds or HTTP-date
+def get_retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+
+
+# Incrementally parse a streamed JSON response body (requests stream=True).
+#   Yields the elements of a top-level array one at a time, while the body is downloaded;
+#   a body that is not an array (e.g. a single object) is yielded as one value.
+def iter_json_array(response, chunk_size=STREAM_CHUNK_SIZE): # pylint: disable=too-many-branches
+    decoder = json_lib.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size=chunk_size)
+
+    def read_more(buffer):
+        chunk = next(chunks, None)
+        if chunk is None:
+            return buffer + utf8_decoder.decode(b'', final=True), True
+        return buffer + utf8_decoder.decode(chunk), False
+
+    try:
+        buffer, done = '', False
+        while not buffer.strip() and not done:
+            buffer, done = read_more(buffer)
+        buffer = buffer.lstrip()
+        if not buffer.startswith('['):
+            while not done:
+                buffer, done = read_more(buffer)
+            if buffer.strip():
+                yield decoder.decode(buffer)
+            return
+
+        position = 1
+        min_size = 0 # min. unparsed size before trying to parse a (large) value again
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position = position + 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            if position >= len(buffer) or (len(buffer) - position < min_size and not done):
+                if done:
+                    raise ValueError('Incomplete JSON array in response body')
+                buffer, done = read_more(buffer[position:])
+                position = 0
+                continue
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if done:
+                    raise
+                min_size = 2 * (len(buffer) - position)
+                continue
+            # A value at the end of the buffer, or a number followed by anything but a separator
+            #   (e.g. 1. or 1e), may continue in the next chunk
+            if (end >= len(buffer) or buffer[end] not in ' \t\r\n,]') and not done:
+                min_size = len(buffer) - position + 1
+                continue
+            if end < len(buffer) and buffer[end] not in ' \t\r\n,]':
+                raise ValueError('Invalid JSON array in response body')
+            min_size = 0
+            position = end
+            yield value
+    finally:
+        response.close()
+
+
 class LookerClient:
 
     # pylint: disable=too-many-instance-attributes
@@ -28,7 +272,19 @@ class LookerClient:
                  domain=None,
                  api_port=None,
                  api_version=None,
-                 user_agent=None):
+                 user_agent=None,
+                 requests_per_second=None,
+                 requests_burst=None,
+                 http_cache_path=None,
+                 http_cache_max_mb=None,
+                 connect_timeout=None,
+                 request_timeout=None,
+                 retry_max_tries=None,
+                 retry_max_time=None,
+                 retry_factor=None,
+                 retry_max_wait=None,
+                 pool_size=None,
+                 compression=True):
         self.__subdomain = subdomain
         self.__client_id = client_id
         self.__client_secret = client_secret
@@ -52,7 +308,48 @@ class LookerClient:
                 self.__subdomain, self.__domain)
         self.__access_token = None
         self.__expires = None
+        # Guards the access token, when the client is shared by sync worker threads
+        self.__token_lock = threading.Lock()
+        # Keep-alive connection pool, shared by the sync worker threads; static headers are
+        #   set once on the session. gzip/deflate response compression is requested, unless
+        #   compression is disabled.
+        #   The pool does not block: streamed responses hold their connection until they are
+        #   read by the main thread, so a thread waiting for a free connection could deadlock;
+        #   extra connections are opened instead, and closed when the pool is full.
         self.__session = requests.Session()
+        if pool_size is None:
+            pool_size = POOL_SIZE_DEFAULT
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=int(pool_size))
+        self.__session.mount('https://', adapter)
+        self.__session.mount('http://', adapter)
+        self.__session.headers.update({
+            'User-Agent': self.__user_agent,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate' if compression else 'identity'})
+        self.http_cache = None
+        if http_cache_path:
+            if http_cache_max_mb is None:
+                http_cache_max_mb = HTTP_CACHE_MAX_MB_DEFAULT
+            self.http_cache = HttpCache(
+                path=http_cache_path,
+                max_bytes=int(float(http_cache_max_mb) * 1024 * 1024))
+        self.rate_limiter = RateLimiter(
+            rate=float(requests_per_second) if requests_per_second else None,
+            burst=int(requests_burst) if requests_burst else None)
+        # (connect, read) timeouts; a request that hangs is retried
+        self.timeout = (
+            float(connect_timeout or CONNECT_TIMEOUT_DEFAULT),
+            float(request_timeout or REQUEST_TIMEOUT_DEFAULT))
+        self.retry_policy = RetryPolicy(
+            max_tries=int(retry_max_tries or RETRY_MAX_TRIES_DEFAULT),
+            max_time=float(retry_max_time or RETRY_MAX_TIME_DEFAULT),
+            factor=float(retry_factor or RETRY_FACTOR_DEFAULT),
+            max_wait=float(retry_max_wait or RETRY_MAX_WAIT_DEFAULT))
+        # Retries by endpoint
+        self.retry_counts = Counter()
+        self.__retry_lock = threading.Lock()
         self.base_url = 'https://{}.{}:{}/api/{}'.format(
             self.__subdomain,
             self.__domain,
@@ -61,34 +358,39 @@ class LookerClient:
         )
 
     def __enter__(self):
-        self.get_access_token()
+        self.__retry('POST', '{}/login'.format(self.base_url), 'login', self.get_access_token)
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
+        if self.retry_counts:
+            LOGGER.info('Retries by endpoint: {}'.format(dict(self.retry_counts)))
+        if self.http_cache:
+            LOGGER.info('HTTP cache: not modified = {}, downloaded = {}'.format(
+                self.http_cache.hits, self.http_cache.misses))
+            self.http_cache.close()
         self.__session.close()
 
     # API Authentication:
     #  https://docs.looker.com/reference/api-and-integration/api-reference/v3.1/api-auth
-    @backoff.on_exception(backoff.expo,
-                          Server5xxError,
-                          max_tries=5,
-                          factor=2)
+    #  Login errors are retried by the caller (__retry), with the retry_policy
     def get_access_token(self):
+        with self.__token_lock:
+            self.__get_access_token()
+
+    def __get_access_token(self):
         if self.__access_token is not None and self.__expires > datetime.utcnow():
             return
 
-        headers = {}
-        headers['User-Agent'] = self.__user_agent
-        headers['Accept'] = 'application/json'
-
         response = self.__session.post(
             url='{}/login'.format(self.base_url),
-            headers=headers,
+            headers={'Authorization': None},
+            timeout=self.timeout,
             data={'client_id': self.__client_id,
                   'client_secret': self.__client_secret})
 
         if response.status_code >= 500:
-            raise Server5xxError()
+            raise Server5xxError('HTTP {} Error: {}/login'.format(
+                response.status_code, self.base_url))
 
         if response.status_code != 200:
             looker_response = response.json()
@@ -102,16 +404,69 @@ class LookerClient:
         self.__access_token = data['access_token']
         expires_seconds = data['expires_in'] - 60 # pad by 60 seconds
         self.__expires = datetime.utcnow() + timedelta(seconds=expires_seconds)
+        self.__session.headers['Authorization'] = 'Bearer {}'.format(self.__access_token)
 
 
-    @backoff.on_exception(backoff.expo,
-                          (Server5xxError, ConnectionError, Server429Error),
-                          max_tries=7,
-                          factor=3)
-    # @utils.ratelimit(400, 60)
-    def request(self, method, path=None, url=None, json=None, **kwargs):
+    def __count_retry(self, endpoint):
+        with self.__retry_lock:
+            self.retry_counts[endpoint or 'other'] += 1
+
+    # Call send() with retries (retry_policy): connection errors and timeouts, HTTP 408 and 5xx
+    #   responses, and HTTP 429 (the rate_limiter holds the retry until the Retry-After pause
+    #   has passed). The retry_after attribute of the error overrides the backoff wait.
+    def __retry(self, method, url, endpoint, send):
+        started = time.monotonic()
+        tries = 0
+        while True:
+            tries = tries + 1
+            try:
+                return send()
+            except RETRY_EXCEPTIONS as err:
+                wait = self.retry_policy.get_wait(tries, getattr(err, 'retry_after', None))
+                if not self.retry_policy.should_retry(tries, started, wait):
+                    LOGGER.error('Giving up {} {} after {} tries: {}'.format(
+                        method, url, tries, err))
+                    raise
+                self.__count_retry(endpoint)
+                LOGGER.warning('Retrying {} {} in {:.1f} seconds (try {}): {}'.format(
+                    method, url, wait, tries, err))
+                time.sleep(wait)
+
+    # Send a request once (logging in first, if the access token expired)
+    def __send_once(self, method, url, endpoint, **kwargs):
         self.get_access_token()
+        self.rate_limiter.acquire()
+        with metrics.http_request_timer(endpoint) as timer:
+            response = self.__session.request(method=method, url=url, **kwargs)
+            timer.tags[metrics.Tag.http_status_code] = response.status_code
 
+        status_code = response.status_code
+        LOGGER.info('status_code = {}'.format(status_code))
+        if status_code >= 500 or status_code == 408:
+            error = Server5xxError('HTTP {} Error: {}'.format(status_code, url))
+            error.retry_after = get_retry_after(response)
+            response.close()
+            raise error
+        #Pause the rate_limiter (Retry-After) and retry if
+        #response code equals 429 because rate limit has been exceeded
+        if status_code == 429:
+            self.rate_limiter.throttled(get_retry_after(response))
+            response.close()
+            error = Server429Error('HTTP 429 Error: {}'.format(url))
+            error.retry_after = 0
+            raise error
+        self.rate_limiter.succeeded()
+        return response
+
+    # Send a request, with retries (one retry_policy for the login and the request)
+    def __send(self, method, url, endpoint, **kwargs):
+        return self.__retry(
+            method,
+            url,
+            endpoint,
+            lambda: self.__send_once(method, url, endpoint, **kwargs))
+
+    def request(self, method, path=None, url=None, json=None, **kwargs):
         if not url and path:
             url = '{}/{}'.format(self.base_url, path)
 
@@ -121,42 +476,60 @@ class LookerClient:
         else:
             endpoint = None
 
+        # Parse a large response incrementally; returns a generator of the array elements
+        stream_json = kwargs.pop('stream_json', False)
+
+        # User-Agent, Accept and Authorization headers are set on the session
         if 'headers' not in kwargs:
             kwargs['headers'] = {}
-        kwargs['headers']['Authorization'] = 'Bearer {}'.format(self.__access_token)
-        kwargs['headers']['User-Agent'] = self.__user_agent
-        kwargs['headers']['Accept'] = 'application/json'
 
         if method == 'POST':
             kwargs['headers']['Content-Type'] = 'application/json'
 
-        with metrics.http_request_timer(endpoint) as timer:
-            response = self.__session.request(
-                method=method,
-                url=url,
-                json=json,
-                **kwargs)
-            timer.tags[metrics.Tag.http_status_code] = response.status_code
+        # Revalidate a response stored in the persistent HTTP cache
+        use_http_cache = self.http_cache is not None and method == 'GET' and not stream_json
+        cached_response = None
+        if use_http_cache:
+            cached_response = self.http_cache.get(url)
+            if cached_response:
+                etag, last_modified, _ = cached_response
+                if etag:
+                    kwargs['headers']['If-None-Match'] = etag
+                if last_modified:
+                    kwargs['headers']['If-Modified-Since'] = last_modified
 
-        status_code = response.status_code
-        LOGGER.info('status_code = {}'.format(status_code))
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = self.timeout
 
-        if status_code >= 500:
-            raise Server5xxError()
+        response = self.__send(
+            method,
+            url,
+            endpoint,
+            json=json,
+            stream=stream_json,
+            **kwargs)
+        status_code = response.status_code
 
-        #Use retry functionality in backoff to wait and retry if
-        #response code equals 429 because rate limit has been exceeded
-        elif status_code == 429:
-            raise Server429Error()
+        if status_code == 304 and cached_response:
+            LOGGER.info('Not modified, HTTP cache hit: {}'.format(url))
+            self.http_cache.touch(url)
+            return json_lib.loads(bytes(cached_response[2]))
 
-        elif status_code == 404:
+        if status_code == 404:
             if endpoint in ('explores', 'models', 'merge_queries', 'queries'):
                 LOGGER.error('HTTP 404 Error, URL Not Found: {}'.format(url))
+                response.close()
                 return None
             else:
                 response.raise_for_status()
 
         elif status_code == 200:
+            if stream_json:
+                return iter_json_array(response)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if use_http_cache and (etag or last_modified or cached_response):
+                self.http_cache.put(url, etag, last_modified, response.content)
             return response.json()
 
         response.raise_for_status()
@@ -1,12 +1,11 @@
 from singer.catalog import Catalog, CatalogEntry, Schema
 from tap_looker.schema import get_schemas
-from tap_looker.streams import flatten_streams
+from tap_looker.streams import STREAM_GRAPH
 
 def discover():
     schemas, field_metadata = get_schemas()
     catalog = Catalog([])
 
-    flat_streams = flatten_streams()
     for stream_name, schema_dict in schemas.items():
         schema = Schema.from_dict(schema_dict)
         mdata = field_metadata[stream_name]
@@ -14,7 +13,7 @@ def discover():
         catalog.streams.append(CatalogEntry(
             stream=stream_name,
             tap_stream_id=stream_name,
-            key_properties=flat_streams.get(stream_name, {}).get('key_properties', None),
+            key_properties=list(STREAM_GRAPH.streams[stream_name].get('key_properties') or []),
             schema=schema,
             metadata=mdata
         ))
@@ -7,6 +7,8 @@
 
 # Run from tap-looker directory:
 #  python tap_looker/generate_schemas.py --config tap_config.json
+# To generate offline, from a saved swagger.json (e.g. tap_looker/schemas/archive/looker_swagger.json),
+#   add "swagger_file": "<path to swagger.json>" to the config.
 
 import singer
 from tap_looker.client import LookerClient
@@ -22,10 +24,10 @@ REQUIRED_CONFIG_KEYS = [
     'user_agent'
 ]
 
-def do_generate_schemas(client):
+def do_generate_schemas(client=None, swagger_file=None):
 
     LOGGER.info('Generating schemas')
-    generate_schemas(client)
+    generate_schemas(client=client, swagger_file=swagger_file)
     LOGGER.info('Finished generating schemas')
 
 
@@ -34,6 +36,11 @@ def main():
 
     parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
 
+    swagger_file = parsed_args.config.get('swagger_file')
+    if swagger_file:
+        do_generate_schemas(swagger_file=swagger_file)
+        return
+
     with LookerClient(subdomain=parsed_args.config['subdomain'],
                       client_id=parsed_args.config['client_id'],
                       client_secret=parsed_args.config['client_secret'],
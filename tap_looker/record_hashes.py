@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import uuid
+import singer
+
+LOGGER = singer.get_logger()
+
+# State key of the run id of the hashes saved (pending) at the end of the last run
+STATE_KEY = 'record_hashes_run_id'
+
+
+# Change detection (record_hashes_path config): per-stream map of primary key -> content hash
+#   of the record emitted in the last run, kept in a JSON file between runs.
+#   Records with the same hash as in the last run are not emitted. Keys of the last run that
+#   were not seen again are deleted records (tombstones).
+#   At the end of a successful run, the hashes are saved to a pending file with a new run id,
+#   and the run id is written to the final STATE. The next run promotes the pending file only
+#   if it starts from that state, i.e. the target and the orchestrator accepted the output of
+#   the run; otherwise the pending file is discarded and the records are emitted again.
+class RecordHashes:
+    def __init__(self, path, state):
+        self.path = path
+        self.pending_path = '{}.pending'.format(path)
+        self.skipped = {}
+        self.__previous = {}
+        self.__current = {}
+        self.__promote_pending(state.get(STATE_KEY))
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.__previous = json.load(file)
+
+    def __promote_pending(self, run_id):
+        if not os.path.exists(self.pending_path):
+            return
+        with open(self.pending_path, 'r') as file:
+            pending = json.load(file)
+        if run_id is not None and pending.get('run_id') == run_id:
+            LOGGER.info('Record hashes of run {} accepted: {}'.format(run_id, self.path))
+            self.__write(self.path, pending.get('hashes', {}))
+        else:
+            LOGGER.warning('Record hashes of run {} discarded, the state is not from that run ' \
+                '(run {}); its records are emitted again'.format(pending.get('run_id'), run_id))
+        os.remove(self.pending_path)
+
+    @staticmethod
+    def __write(path, content):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'w') as file:
+            json.dump(content, file, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def get_key(key_properties, record):
+        return json.dumps([record.get(key) for key in key_properties], default=str)
+
+    @staticmethod
+    def get_hash(record):
+        content = json.dumps(record, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.blake2b(content, digest_size=8).hexdigest()
+
+    # Stream synced in this run; its keys not seen in this run are deleted
+    def start_stream(self, stream_name):
+        self.__current.setdefault(stream_name, {})
+        self.skipped.setdefault(stream_name, 0)
+
+    # Stream resumed after an interrupted run: the hashes of the last run are kept for the
+    #   records that are not synced again in this run (and they are not deleted)
+    def resume_stream(self, stream_name):
+        self.start_stream(stream_name)
+        for key, record_hash in self.__previous.get(stream_name, {}).items():
+            self.__current[stream_name].setdefault(key, record_hash)
+
+    # Records the record hash; False if the record did not change since the last run
+    def is_changed(self, stream_name, key_properties, record):
+        key = self.get_key(key_properties, record)
+        record_hash = self.get_hash(record)
+        self.__current[stream_name][key] = record_hash
+        if self.__previous.get(stream_name, {}).get(key) == record_hash:
+            self.skipped[stream_name] = self.skipped[stream_name] + 1
+            return False
+        return True
+
+    # Keys (lists of key values) of the last run that were not seen in this run, by stream
+    def get_deleted_keys(self):
+        deleted_keys = {}
+        for stream_name, hashes in self.__current.items():
+            deleted = [json.loads(key) for key in self.__previous.get(stream_name, {}) \
+                if key not in hashes]
+            if deleted:
+                deleted_keys[stream_name] = deleted
+        return deleted_keys
+
+    # Save the hashes of the streams synced in this run, and keep the others, to the pending
+    #   file; sets the run id in the state (written by the caller as the final STATE)
+    def save(self, state):
+        hashes = dict(self.__previous)
+        hashes.update(self.__current)
+        run_id = uuid.uuid4().hex
+        self.__write(self.pending_path, {'run_id': run_id, 'hashes': hashes})
+        state[STATE_KEY] = run_id
+        for stream_name, skipped in self.skipped.items():
+            LOGGER.info('{}: unchanged records not emitted = {}'.format(stream_name, skipped))
@@ -1,8 +1,10 @@
+import functools
+import hashlib
 import os
 import json
 import singer
 from singer import metadata
-from tap_looker.streams import flatten_streams
+from tap_looker.streams import STREAM_GRAPH
 from tap_looker.transform import get_transform_schema
 
 LOGGER = singer.get_logger()
@@ -14,10 +16,24 @@ def get_abs_path(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
 
 
+# Load the Looker API Swagger Definitions, from a local file (e.g. schemas/archive/looker_swagger.json)
+#   or from the API swagger.json endpoint.
+def load_swagger(client=None, swagger_file=None):
+    if swagger_file:
+        LOGGER.info('Loading swagger definitions from file: {}'.format(swagger_file))
+        with open(swagger_file, encoding='utf-8') as file:
+            return json.load(file)
+    LOGGER.info('Loading swagger definitions from API')
+    endpoint = 'swagger.json'
+    return client.request(method='GET', path=endpoint, endpoint=endpoint)
+
+
 # DEVELOPMENT ONLY. Run from generate_schemas.py to create initial drafts of JSON Schems
 #   from the Looker API Swagger Definitions file.
-def generate_schemas(client):
-    flat_streams = flatten_streams()
+def generate_schemas(client=None, swagger_file=None):
+    swagger = load_swagger(client=client, swagger_file=swagger_file)
+    resolved_refs = {}
+    flat_streams = STREAM_GRAPH.streams
     cwd = os.getcwd()
     flat_streams_list = []
     for stream_name, stream_metadata in flat_streams.items():
@@ -26,22 +42,40 @@ def generate_schemas(client):
             if stream_name not in flat_streams_list:
                 flat_streams_list.append(stream_name)
             swagger_object = stream_metadata.get('swagger_object')
-            schema = get_transform_schema(client, swagger_object, stream_name)
+            schema = get_transform_schema(swagger, swagger_object, stream_name, resolved_refs)
             schema_path = get_abs_path('{}/tap_looker/schemas/{}.json'.format(cwd, stream_name))
             with open(schema_path, 'w', encoding='utf-8') as file:
                 json.dump(schema, file, ensure_ascii=False, indent=2, sort_keys=True)
     LOGGER.info('Generated schemas for: {}'.format(sorted(flat_streams_list)))
 
 
-def get_schemas():
+# Parsed JSON schemas, by file content hash: identical schema files (e.g. folders and spaces)
+#   are parsed once, and share the same (read-only) dict
+SCHEMAS_BY_CONTENT = {}
+
+
+# JSON schema of a stream, loaded once (on first use) and cached; do not modify it
+@functools.lru_cache(maxsize=None)
+def load_schema(stream_name):
+    schema_path = get_abs_path('schemas/{}.json'.format(stream_name))
+    with open(schema_path, 'rb') as file:
+        content = file.read()
+    content_hash = hashlib.md5(content).hexdigest()
+    if content_hash not in SCHEMAS_BY_CONTENT:
+        SCHEMAS_BY_CONTENT[content_hash] = json.loads(content.decode('utf-8'))
+    return SCHEMAS_BY_CONTENT[content_hash]
+
+
+# JSON schemas and standard metadata of the streams (default: all streams)
+def get_schemas(stream_names=None):
     schemas = {}
     field_metadata = {}
 
-    flat_streams = flatten_streams()
-    for stream_name, stream_metadata in flat_streams.items():
-        schema_path = get_abs_path('schemas/{}.json'.format(stream_name))
-        with open(schema_path) as file:
-            schema = json.load(file)
+    if stream_names is None:
+        stream_names = STREAM_GRAPH.streams.keys()
+    for stream_name in stream_names:
+        stream_metadata = STREAM_GRAPH.streams[stream_name]
+        schema = load_schema(stream_name)
         schemas[stream_name] = schema
         mdata = metadata.new()
 
@@ -51,8 +85,8 @@ def get_schemas():
         # https://github.com/singer-io/singer-python/blob/master/singer/metadata.py#L25-L44
         mdata = metadata.get_standard_metadata(
             schema=schema,
-            key_properties=stream_metadata.get('key_properties', None),
-            valid_replication_keys=stream_metadata.get('replication_keys', None),
+            key_properties=list(stream_metadata.get('key_properties') or []),
+            valid_replication_keys=list(stream_metadata.get('replication_keys') or []) or None,
             replication_method=stream_metadata.get('replication_method', None)
         )
         field_metadata[stream_name] = mdata
@@ -1,3 +1,5 @@
+from types import MappingProxyType
+
 # streams: API URL endpoints to be called
 # properties:
 #   <root node>: Plural stream name for the endpoint
@@ -6,11 +8,23 @@
 #   key_properties: Primary key fields for identifying an endpoint record.
 #   replication_method: INCREMENTAL or FULL_TABLE
 #   replication_keys: bookmark_field(s), typically a date-time, used for filtering the results
-#        and setting the state
+#        and setting the state. The Looker API does not filter on these fields; records are
+#        filtered after they are requested, and the state is set at the end of the sync.
 #   params: Query, sort, and other endpoint specific parameters; default = {}
 #   data_key: JSON element containing the results list for the endpoint; default = 'results'
-#   bookmark_query_field: From date-time field used for filtering the query
+#   bookmark_query_field: From date-time field used for filtering the query; the query is run
+#       for date windows, from the bookmark (or start_date) to now
+#   row_limit: Max. number of rows returned by an inline query (limit parameter)
 #   swagger_object: Looker Swagger API object reference with definitions for JSON schemas
+#   page_size: Number of records per page, for endpoints that support pagination; default = None
+#       Paginated parents must be requested sorted by their id (e.g. users?sorts=id), so the
+#       parent/child checkpoints can resume across pages
+#   pagination: 'offset' (limit and offset parameters) or 'page' (page and per_page parameters);
+#       default = 'offset'
+#   shared: Child paths shared by several parents/streams (e.g. queries/{id}); each resolved
+#       path is requested and synced only once per run; default = False
+#   deferred: Child requests of all parents are fetched after the top-level stream is synced,
+#       concurrently, the slowest (in the last run) first; default = False
 
 STREAMS = {
     'color_collections': {
@@ -24,9 +38,11 @@ STREAMS = {
         'swagger_object': 'DBConnection'
     },
     'dashboards': {
+        'path': 'dashboards/search?sorts=id&deleted=false',
         'key_properties': ['id'],
         'replication_method': 'FULL_TABLE',
         'swagger_object': 'DashboardBase',
+        'page_size': 1000,
         'children': {
             'dashboard_elements': {
                 'path': 'dashboards/{}/dashboard_elements',
@@ -38,18 +54,21 @@ STREAMS = {
                         'path': 'queries/[query_id]',
                         'key_properties': ['id'],
                         'replication_method': 'FULL_TABLE',
+                        'shared': True,
                         'swagger_object': 'Query'
                     },
                     'merge_queries': {
                         'path': 'merge_queries/[merge_result_id]',
                         'key_properties': ['id'],
                         'replication_method': 'FULL_TABLE',
+                        'shared': True,
                         'swagger_object': 'MergeQuery',
                         'children': {
                             'queries': {
                                 'path': 'queries/[query_id]',
                                 'key_properties': ['id'],
                                 'replication_method': 'FULL_TABLE',
+                                'shared': True,
                                 'swagger_object': 'Query'
                             }
                         }
@@ -72,12 +91,14 @@ STREAMS = {
                 'path': 'content_metadata/[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'scheduled_plans': {
                 'path': 'scheduled_plans/dashboard/{}?all_users=true',
                 'key_properties': ['id'],
-                'replication_method': 'FULL_TABLE',
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['updated_at'],
                 'swagger_object': 'ScheduledPlan'
             }
         }
@@ -96,18 +117,21 @@ STREAMS = {
                 'path': 'content_metadata?parent_id=[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'content_metadata': {
                 'path': 'content_metadata/[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'content_metadata_access': {
                 'path': 'content_metadata_access?content_metadata_id=[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMetaGroupUser'
             }
         }
@@ -135,12 +159,14 @@ STREAMS = {
                 'path': 'content_metadata/[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'content_metadata_access': {
                 'path': 'content_metadata_access?content_metadata_id=[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMetaGroupUser'
             }
         }
@@ -164,7 +190,8 @@ STREAMS = {
             'scheduled_plans': {
                 'path': 'scheduled_plans/lookml_dashboard/{}?all_users=true',
                 'key_properties': ['id'],
-                'replication_method': 'FULL_TABLE',
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['updated_at'],
                 'swagger_object': 'ScheduledPlan'
             }
         }
@@ -184,6 +211,7 @@ STREAMS = {
                         'path': 'lookml_models/{}/explores/[child_id]',
                         'key_properties': ['id'],
                         'replication_method': 'FULL_TABLE',
+                        'deferred': True,
                         'swagger_object': 'LookmlModelExplore'
                     }
                 }
@@ -191,26 +219,32 @@ STREAMS = {
         }
     },
     'looks': {
+        'path': 'looks/search?sorts=id&deleted=false',
         'key_properties': ['id'],
-        'replication_method': 'FULL_TABLE',
+        'replication_method': 'INCREMENTAL',
+        'replication_keys': ['updated_at'],
         'swagger_object': 'Look',
+        'page_size': 1000,
         'children': {
             'queries': {
                 'path': 'queries/[query_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'Query'
             },
             'content_metadata': {
                 'path': 'content_metadata/[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'scheduled_plans': {
                 'path': 'scheduled_plans/look/{}?all_users=true',
                 'key_properties': ['id'],
-                'replication_method': 'FULL_TABLE',
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['updated_at'],
                 'swagger_object': 'ScheduledPlan'
             }
         }
@@ -268,7 +302,8 @@ STREAMS = {
     'scheduled_plans': {
         'path': 'scheduled_plans?all_users=true',
         'key_properties': ['id'],
-        'replication_method': 'FULL_TABLE',
+        'replication_method': 'INCREMENTAL',
+        'replication_keys': ['updated_at'],
         'swagger_object': 'ScheduledPlan'
     },
     'spaces': {
@@ -280,18 +315,21 @@ STREAMS = {
                 'path': 'content_metadata?parent_id=[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'content_metadata': {
                 'path': 'content_metadata/[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMeta'
             },
             'content_metadata_access': {
                 'path': 'content_metadata_access?content_metadata_id=[content_metadata_id]',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
+                'shared': True,
                 'swagger_object': 'ContentMetaGroupUser'
             }
         }
@@ -320,9 +358,12 @@ STREAMS = {
         'swagger_object': 'UserLoginLockout'
     },
     'users': {
+        'path': 'users?sorts=id',
         'key_properties': ['id'],
         'replication_method': 'FULL_TABLE',
         'swagger_object': 'User',
+        'pagination': 'page',
+        'page_size': 500,
         'children': {
             'user_attribute_values': {
                 'path': 'users/{}/attribute_values?all_values=true&include_unset=true',
@@ -333,20 +374,24 @@ STREAMS = {
             'user_sessions': {
                 'path': 'users/{}/sessions',
                 'key_properties': ['id'],
-                'replication_method': 'FULL_TABLE',
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['created_at'],
                 'swagger_object': 'Session'
             },
             'content_favorites': {
-                'path': 'content_favorite/search?user_id={}',
+                'path': 'content_favorite/search?user_id={}&sorts=id',
                 'key_properties': ['id'],
                 'replication_method': 'FULL_TABLE',
-                'swagger_object': 'ContentFavorite'
+                'swagger_object': 'ContentFavorite',
+                'page_size': 1000
             },
             'content_views': {
-                'path': 'content_view/search?user_id={}',
+                'path': 'content_view/search?user_id={}&sorts=id',
                 'key_properties': ['id'],
-                'replication_method': 'FULL_TABLE',
-                'swagger_object': 'ContentView'
+                'replication_method': 'INCREMENTAL',
+                'replication_keys': ['last_viewed_at'],
+                'swagger_object': 'ContentView',
+                'page_size': 1000
             }
         }
     },
@@ -361,9 +406,12 @@ STREAMS = {
         'swagger_object': 'Workspace'
     },
     'query_history': {
-        'path': 'queries/run/json?limit=10000&apply_formatting=false&apply_vis=false&cache=false&force_production=true&server_table_calcs=false',
+        'path': 'queries/run/json?apply_formatting=false&apply_vis=false&cache=false&force_production=true&server_table_calcs=false',
         'key_properties': ['query_id', 'history_created_date', 'dims_hash_key'],
-        'replication_method': 'FULL_TABLE',
+        'replication_method': 'INCREMENTAL',
+        'replication_keys': ['history_created_date'],
+        'bookmark_query_field': 'history.created_date',
+        'row_limit': 10000,
         'method': 'POST',
         'body': {
             'model': 'i__looker',
@@ -383,7 +431,6 @@ STREAMS = {
             'filters': {
                 'query.model': '-EMPTY',
                 'history.runtime': 'NOT NULL',
-                'history.created_date': '1 week',
                 'user.is_looker': 'No'
             },
             'sorts': [
@@ -394,37 +441,95 @@ STREAMS = {
     }
 }
 
-# De-nest children nodes for Discovery mode
-def flatten_streams():
-    flat_streams = {}
-    # Loop through parents
-    for stream_name, endpoint_config in STREAMS.items():
-        flat_streams[stream_name] = {
-            'key_properties': endpoint_config.get('key_properties'),
-            'replication_method': endpoint_config.get('replication_method'),
-            'replication_keys': endpoint_config.get('replication_keys'),
-            'swagger_object': endpoint_config.get('swagger_object')
-        }
-        # Loop through children
-        children = endpoint_config.get('children')
-        if children:
-            for child_stream_name, child_endpoint_config in children.items():
-                flat_streams[child_stream_name] = {
-                    'key_properties': child_endpoint_config.get('key_properties'),
-                    'replication_method': child_endpoint_config.get('replication_method'),
-                    'replication_keys': child_endpoint_config.get('replication_keys'),
-                    'swagger_object': child_endpoint_config.get('swagger_object')
-                }
-                # Loop through grand-children
-                grandchildren = child_endpoint_config.get('children')
-                if grandchildren:
-                    for grandchild_stream_name, grandchild_endpoint_config in \
-                        grandchildren.items():
-                        flat_streams[grandchild_stream_name] = {
-                            'key_properties': grandchild_endpoint_config.get('key_properties'),
-                            'replication_method': grandchild_endpoint_config.get\
-                                ('replication_method'),
-                            'replication_keys': grandchild_endpoint_config.get('replication_keys'),
-                            'swagger_object': grandchild_endpoint_config.get('swagger_object')
-                        }
-    return flat_streams
+# Stream graph index of STREAMS, built once at import; immutable.
+#   streams: flat stream metadata, by stream name (for discovery and schemas)
+#   children: child stream names, by parent stream name (all levels, all tree paths)
+#   tree_paths: the tree paths (stream names from the top-level stream) that produce a stream,
+#       e.g. queries: dashboards/dashboard_elements/queries, looks/queries, ...
+#   ancestors: the ancestor stream names of a stream (all tree paths)
+#   descendants: the descendant stream names of a stream (all tree paths)
+#   top_level: the top-level stream names (e.g. scheduled_plans, also a child of dashboards)
+# A stream with several parents (e.g. content_metadata, queries) must have the same metadata
+#   under each of them.
+STREAM_METADATA_KEYS = ('key_properties', 'replication_method', 'replication_keys', \
+    'swagger_object')
+
+
+class StreamGraph:
+    def __init__(self, streams):
+        flat_streams = {}
+        children = {}
+        tree_paths = {}
+        self.__add_streams(streams, (), flat_streams, children, tree_paths)
+
+        descendants = {}
+        for stream_name in flat_streams:
+            descendants[stream_name] = self.__get_descendants(stream_name, children)
+        ancestors = {}
+        for stream_name, stream_tree_paths in tree_paths.items():
+            ancestors[stream_name] = frozenset(
+                ancestor for tree_path in stream_tree_paths for ancestor in tree_path[:-1])
+
+        self.streams = MappingProxyType(flat_streams)
+        self.children = MappingProxyType(
+            {stream_name: tuple(child_names) for stream_name, child_names in children.items()})
+        self.tree_paths = MappingProxyType(
+            {stream_name: tuple(paths) for stream_name, paths in tree_paths.items()})
+        self.ancestors = MappingProxyType(ancestors)
+        self.descendants = MappingProxyType(descendants)
+        self.top_level = frozenset(streams)
+
+    def __add_streams(self, streams, parent_path, flat_streams, children, tree_paths):
+        for stream_name, endpoint_config in streams.items():
+            stream_metadata = {}
+            for key in STREAM_METADATA_KEYS:
+                value = endpoint_config.get(key)
+                stream_metadata[key] = tuple(value) if isinstance(value, list) else value
+            stream_metadata = MappingProxyType(stream_metadata)
+            if stream_name in flat_streams and flat_streams[stream_name] != stream_metadata:
+                raise ValueError('Stream {} has different metadata under {}'.format(
+                    stream_name, '/'.join(parent_path)))
+            flat_streams[stream_name] = stream_metadata
+            tree_path = parent_path + (stream_name,)
+            tree_paths.setdefault(stream_name, []).append(tree_path)
+            child_names = children.setdefault(stream_name, [])
+            for child_stream_name in endpoint_config.get('children', {}):
+                if child_stream_name not in child_names:
+                    child_names.append(child_stream_name)
+            self.__add_streams(
+                endpoint_config.get('children', {}), tree_path, flat_streams, children, tree_paths)
+
+    @staticmethod
+    def __get_descendants(stream_name, children):
+        descendants = set()
+        pending = list(children[stream_name])
+        while pending:
+            child_stream_name = pending.pop()
+            if child_stream_name not in descendants:
+                descendants.add(child_stream_name)
+                pending.extend(children[child_stream_name])
+        return frozenset(descendants)
+
+    # The stream (under parent_stream_name, if a child) is synced: it has selected descendants
+    #   that are not top-level streams, or it is selected. A selected top-level stream (e.g.
+    #   scheduled_plans) is synced from its own endpoint: its unselected ancestors are not
+    #   requested ID-only for it, and it is synced as a child only under a selected parent.
+    def has_selected(self, stream_name, selected_streams, parent_stream_name=None):
+        if any(descendant in selected_streams and descendant not in self.top_level \
+            for descendant in self.descendants.get(stream_name, frozenset())):
+            return True
+        if stream_name not in selected_streams:
+            return False
+        return parent_stream_name is None or parent_stream_name in selected_streams or \
+            stream_name not in self.top_level
+
+    # Parent/child stream pairs of a stream and its descendants
+    def get_edges(self, stream_name):
+        edges = []
+        for parent_stream_name in (stream_name,) + tuple(sorted(self.descendants[stream_name])):
+            for child_stream_name in self.children[parent_stream_name]:
+                edges.append((parent_stream_name, child_stream_name))
+        return edges
+
+
+STREAM_GRAPH = StreamGraph(STREAMS)
@@ -1,30 +1,44 @@
+import collections
+import collections.abc
+import copy
+from datetime import timedelta
 import json
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import singer
 from singer import metrics, metadata, utils, Transformer
-from tap_looker.transform import transform_json
-from tap_looker.streams import STREAMS
+from singer.utils import strptime_to_utc
+from tap_looker.transform import transform_json, compile_record_transform, get_excluded_fields
+from tap_looker.record_hashes import RecordHashes
+from tap_looker.streams import STREAMS, STREAM_GRAPH
+from tap_looker.writer import MESSAGE_WRITER
 
 LOGGER = singer.get_logger()
 
+CHECKPOINT_INTERVAL_DEFAULT = 60 # seconds
+
+# The schema of a stream is materialized (to_dict) and written once per run, when the stream
+#   is first synced; only the schemas of the selected streams are written. A changed schema
+#   (e.g. tombstones) is written with MESSAGE_WRITER.write_schema.
 def write_schema(catalog, stream_name):
+    if MESSAGE_WRITER.has_schema(stream_name):
+        return
     stream = catalog.get_stream(stream_name)
     schema = stream.schema.to_dict()
     try:
-        singer.write_schema(stream_name, schema, stream.key_properties)
+        MESSAGE_WRITER.write_schema(stream_name, schema, stream.key_properties)
     except OSError as err:
         LOGGER.info('OS Error writing schema for: {}'.format(stream_name))
         raise err
 
 
-def write_record(catalog, stream_name, url, record, time_extracted):
+# Records are buffered and written in batches by the MESSAGE_WRITER
+def write_record(catalog, stream_name, url, record, time_extracted): # pylint: disable=unused-argument
     try:
-        singer.messages.write_record(stream_name, record, time_extracted=time_extracted)
+        MESSAGE_WRITER.write_record(stream_name, record, time_extracted=time_extracted)
     except OSError as err:
-        stream = catalog.get_stream(stream_name)
-        schema = stream.schema.to_dict()
         LOGGER.info('\n\n{} URL: {}\n\n'.format(stream_name, url))
-        LOGGER.info('{} schema:'.format(stream_name))
-        LOGGER.info(json.dumps(schema, indent=2, sort_keys=True))
         LOGGER.info('\n\nOS Error writing record for: {}, record:'.format(stream_name))
         LOGGER.info(json.dumps(record, indent=2, sort_keys=True))
         raise err
@@ -44,7 +58,7 @@ def write_bookmark(state, stream, value):
         state['bookmarks'] = {}
     state['bookmarks'][stream] = value
     LOGGER.info('Write state for stream: {}, value: {}'.format(stream, value))
-    singer.write_state(state)
+    MESSAGE_WRITER.write_state(state)
 
 
 def transform_datetime(this_dttm):
@@ -53,6 +67,14 @@ def transform_datetime(this_dttm):
     return new_dttm
 
 
+# Compile the record transform for a stream from the catalog schema and metadata
+def compile_stream_transform(catalog, stream_name):
+    stream = catalog.get_stream(stream_name)
+    schema = stream.schema.to_dict()
+    stream_metadata = metadata.to_map(stream.metadata)
+    return compile_record_transform(schema, stream_metadata)
+
+
 def process_records(catalog, #pylint: disable=too-many-branches
                     stream_name,
                     records,
@@ -62,10 +84,31 @@ def process_records(catalog, #pylint: disable=too-many-branches
                     last_datetime=None,
                     parent=None,
                     parent_id=None,
-                    url=None):
-    stream = catalog.get_stream(stream_name)
-    schema = stream.schema.to_dict()
-    stream_metadata = metadata.to_map(stream.metadata)
+                    url=None,
+                    record_transforms=None,
+                    record_hashes=None):
+    if record_transforms and stream_name in record_transforms:
+        transform_record = record_transforms[stream_name]
+    else:
+        transform_record = compile_stream_transform(catalog, stream_name)
+
+    # Change detection, for FULL_TABLE streams (no bookmark_field)
+    key_properties = None
+    if record_hashes is not None and not bookmark_field:
+        key_properties = catalog.get_stream(stream_name).key_properties
+        record_hashes.start_stream(stream_name)
+
+    # Bookmarks: transformed date-times (format date-time) are compared as strings; the
+    #   last_datetime and max_bookmark_value are transformed once, not for each record
+    last_dttm = None
+    bookmark_is_formatted = False
+    if bookmark_field:
+        last_dttm = transform_datetime(last_datetime)
+        if max_bookmark_value is not None:
+            max_bookmark_value = transform_datetime(max_bookmark_value)
+        bookmark_schema = catalog.get_stream(stream_name).schema.properties.get(bookmark_field)
+        bookmark_is_formatted = bookmark_schema is not None and \
+            bookmark_schema.format == 'date-time'
 
     with metrics.record_counter(stream_name) as counter:
         for record in records:
@@ -75,36 +118,472 @@ def process_records(catalog, #pylint: disable=too-many-branches
                 record['{}_id'.format(parent)] = parent_id
 
             # Transform record for Singer.io
-            with Transformer() as transformer:
-                transformed_record = transformer.transform(
-                    record,
-                    schema,
-                    stream_metadata)
+            transformed_record = transform_record(record)
 
-                # Reset max_bookmark_value to new value if higher
-                if transformed_record.get(bookmark_field):
-                    if max_bookmark_value is None or \
-                        transformed_record[bookmark_field] > transform_datetime(max_bookmark_value):
-                        max_bookmark_value = transformed_record[bookmark_field]
+            # Skip records not changed since the last run
+            if key_properties and not record_hashes.is_changed(
+                    stream_name, key_properties, transformed_record):
+                continue
 
-                if bookmark_field and (bookmark_field in transformed_record):
-                    last_dttm = transform_datetime(last_datetime)
-                    bookmark_dttm = transform_datetime(transformed_record[bookmark_field])
-                    # Keep only records whose bookmark is after the last_datetime
-                    if bookmark_dttm >= last_dttm:
-                        write_record(catalog, stream_name, url, transformed_record, \
-                            time_extracted=time_extracted)
-                        counter.increment()
+            if bookmark_field and transformed_record.get(bookmark_field):
+                if bookmark_is_formatted:
+                    bookmark_dttm = transformed_record[bookmark_field]
                 else:
+                    bookmark_dttm = transform_datetime(transformed_record[bookmark_field])
+                # Reset max_bookmark_value to new value if higher
+                if max_bookmark_value is None or bookmark_dttm > max_bookmark_value:
+                    max_bookmark_value = bookmark_dttm
+                # Keep only records whose bookmark is after the last_datetime
+                if bookmark_dttm >= last_dttm:
                     write_record(catalog, stream_name, url, transformed_record, \
                         time_extracted=time_extracted)
                     counter.increment()
+            else:
+                write_record(catalog, stream_name, url, transformed_record, \
+                    time_extracted=time_extracted)
+                counter.increment()
 
         return max_bookmark_value, counter.value
 
 
+# Pagination: path for page_number (0 = first page), for endpoints with a page_size
+#   pagination = 'offset' (default): limit and offset query parameters
+#   pagination = 'page': page (1 = first page) and per_page query parameters
+def get_page_path(path, endpoint_config, page_number):
+    page_size = endpoint_config.get('page_size')
+    if not page_size:
+        return path
+    separator = '&' if '?' in path else '?'
+    if endpoint_config.get('pagination') == 'page':
+        return '{}{}page={}&per_page={}'.format(path, separator, page_number + 1, page_size)
+    return '{}{}limit={}&offset={}'.format(
+        path, separator, page_size, page_number * page_size)
+
+
+# A page with less than page_size records is the last page
+def is_last_page(data, endpoint_config):
+    page_size = endpoint_config.get('page_size')
+    return not page_size or not isinstance(data, list) or len(data) < page_size
+
+
+# Streamed responses (stream_responses config): parse and process the records of a response
+#   one at a time, while downloading. Only for endpoints without pagination and without selected
+#   descendants in the stream graph (the records of a parent are kept to sync its children,
+#   e.g. the explores of models).
+def is_streamed(stream_name, endpoint_config, selected_streams, stream_responses):
+    if not stream_responses or endpoint_config.get('page_size'):
+        return False
+    return STREAM_GRAPH.descendants[stream_name].isdisjoint(selected_streams)
+
+
+# Parent fields used for the paths (and parent ids) of the child requests of the children
+#   with selected streams in their subtree
+def get_parent_fields(stream_name, endpoint_config, selected_streams):
+    key_properties = endpoint_config.get('key_properties') or []
+    fields = set()
+    for child_stream_name, child_endpoint_config in endpoint_config.get('children', {}).items():
+        if STREAM_GRAPH.has_selected(child_stream_name, selected_streams, stream_name):
+            if 'id' in key_properties:
+                fields.add('id')
+            elif key_properties:
+                fields.add(key_properties[0])
+            # Path parameters from the parent record, e.g. [query_id]
+            fields.update(re.findall(r'\[(\w+)\]', child_endpoint_config.get('path', '')))
+            # models: explores are the children ([child_id])
+            if stream_name == 'models':
+                fields.add('explores')
+    fields.discard('child_id')
+    return fields
+
+
+# Field projection (fields parameter) for a GET endpoint: the selected fields of the stream,
+#   its key and replication key fields, and the parent fields of its children. Only the parent
+#   fields for an ID-only parent (not selected, with selected descendants). None if no fields
+#   are excluded.
+def get_fields_projection(catalog, stream_name, endpoint_config, selected_streams):
+    if endpoint_config.get('method', 'GET') != 'GET':
+        return None
+    if stream_name not in selected_streams:
+        return ','.join(sorted(get_parent_fields(stream_name, endpoint_config, selected_streams)))
+    stream = catalog.get_stream(stream_name)
+    if stream is None:
+        return None
+    excluded_fields = get_excluded_fields(metadata.to_map(stream.metadata))
+    properties = stream.schema.properties or {}
+    if not excluded_fields.intersection(properties):
+        return None
+
+    fields = set(properties).difference(excluded_fields)
+    fields.update(endpoint_config.get('key_properties') or [])
+    fields.update(endpoint_config.get('replication_keys') or [])
+    fields.update(get_parent_fields(stream_name, endpoint_config, selected_streams))
+    return ','.join(sorted(fields))
+
+
+# Run-scoped copy of STREAMS, without the subtrees with no selected streams, and with the
+#   fields projection of each (nested) endpoint config
+def get_sync_streams(catalog, selected_streams, streams=None, field_projection=True,
+                     parent_stream_name=None):
+    if streams is None:
+        streams = STREAMS
+    sync_streams = {}
+    for stream_name, endpoint_config in streams.items():
+        if not STREAM_GRAPH.has_selected(stream_name, selected_streams, parent_stream_name):
+            continue
+        sync_endpoint_config = dict(endpoint_config)
+        if field_projection:
+            sync_endpoint_config['fields'] = get_fields_projection(
+                catalog, stream_name, endpoint_config, selected_streams)
+        if endpoint_config.get('children'):
+            sync_endpoint_config['children'] = get_sync_streams(
+                catalog,
+                selected_streams,
+                endpoint_config.get('children'),
+                field_projection,
+                stream_name)
+        sync_streams[stream_name] = sync_endpoint_config
+    return sync_streams
+
+
+# Get data, API request
+def fetch_endpoint(client, stream_name, path, method, endpoint_config, stream_json=False):
+    if endpoint_config.get('fields'):
+        path = '{}{}fields={}'.format(
+            path, '&' if '?' in path else '?', endpoint_config.get('fields'))
+    url = '{}/{}'.format(client.base_url, path)
+    LOGGER.info('URL for {}: {}'.format(stream_name, url))
+    body = endpoint_config.get('body')
+    data = client.request(
+        method=method,
+        path=path,
+        endpoint=stream_name,
+        json=body,
+        stream_json=stream_json)
+    return data
+
+
+# Transform API records for Singer.io; counts the records queried in stats
+def transform_records(data_set, stream_name, stats):
+    for record in data_set:
+        transformed_record = transform_json(record, stream_name)
+        if transformed_record:
+            stats['records_queried'] = stats['records_queried'] + 1
+            yield transformed_record
+
+
+# Parent id field of a parent record: id, or the first key property
+def get_parent_id_field(id_fields):
+    i = 0
+    for id_field in id_fields:
+        if i == 0:
+            parent_id_field = id_field
+        if id_field == 'id':
+            parent_id_field = id_field
+        i = i + 1
+    return parent_id_field
+
+
+# Child ids of a parent record, for paths with [child_id]: the explores of a model;
+#   ['self'] for the other streams
+def get_child_ids(stream_name, record):
+    if stream_name != 'models':
+        return ['self']
+    child_ids = []
+    for explore in record.get('explores') or []:
+        explore_name = explore.get('name')
+        if explore_name:
+            child_ids.append(explore_name)
+    return child_ids
+
+
+# Planning: expand the parent records into the concrete child requests of a child stream.
+#   Each child path is requested once per plan; shared child paths once per run.
+def plan_child_requests(stream_name, #pylint: disable=too-many-branches
+                        child_stream_name,
+                        child_endpoint_config,
+                        parent_records,
+                        parent_id_field,
+                        selected_streams,
+                        synced_paths=None,
+                        stream_responses=False):
+    child_requests = []
+    planned_paths = set()
+    duplicates = 0
+    stream_json = is_streamed(
+        child_stream_name, child_endpoint_config, selected_streams, stream_responses)
+    for record in parent_records:
+        do_pass = True
+        parent_id = record.get(parent_id_field)
+        if parent_id:
+            child_path = child_endpoint_config.get('path').format(str(parent_id))
+        else:
+            do_pass = False
+            child_path = child_endpoint_config.get('path')
+
+        content_metadata_id = record.get('content_metadata_id')
+        if content_metadata_id:
+            child_path = child_path.replace('[content_metadata_id]', \
+                str(content_metadata_id))
+        elif child_stream_name in ['content_metadata', 'content_metadata_access']:
+            do_pass = False
+
+        query_id = record.get('query_id')
+        if query_id:
+            child_path = child_path.replace('[query_id]', str(query_id))
+        elif child_stream_name == 'queries':
+            do_pass = False
+
+        merge_result_id = record.get('merge_result_id')
+        if merge_result_id:
+            child_path = child_path.replace('[merge_result_id]', str(merge_result_id))
+        elif child_stream_name == 'merge_queries':
+            do_pass = False
+
+        if not do_pass:
+            LOGGER.info('{}, PATH does not pass: {}'.format(child_stream_name, child_path))
+            continue
+
+        for child in get_child_ids(stream_name, record):
+            if child != 'self':
+                concrete_path = child_path.replace('[child_id]', str(child))
+            else:
+                concrete_path = child_path
+            if concrete_path in planned_paths:
+                duplicates = duplicates + 1
+                continue
+            planned_paths.add(concrete_path)
+            # Shared children (e.g. queries) are synced once per path per run
+            if child_endpoint_config.get('shared') and synced_paths is not None:
+                synced_paths[(child_stream_name, concrete_path)] += 1
+                if synced_paths[(child_stream_name, concrete_path)] > 1:
+                    LOGGER.info('{}, already synced: {}'.format(
+                        child_stream_name, concrete_path))
+                    duplicates = duplicates + 1
+                    continue
+            child_requests.append({
+                'stream_name': child_stream_name,
+                'path': concrete_path,
+                'method': child_endpoint_config.get('method', 'GET'),
+                'endpoint_config': child_endpoint_config,
+                'stream_json': stream_json,
+                'parent_id': parent_id,
+                'child': child
+            })
+    if duplicates:
+        LOGGER.info('{}: {} duplicate child paths not requested'.format(
+            child_stream_name, duplicates))
+    return child_requests
+
+
+# Sort key of a parent id: numeric ids in numeric order, then the other ids (e.g. model
+#   names) in string order
+def get_parent_sort_key(parent_id):
+    if parent_id is None:
+        return (0, 0, '')
+    if isinstance(parent_id, int) or str(parent_id).isdigit():
+        return (1, int(parent_id), '')
+    return (2, 0, str(parent_id))
+
+
+# State (bookmarks) key of the checkpoint of a parent/child stream pair
+def get_checkpoint_key(parent_stream_name, child_stream_name):
+    return '{}__{}'.format(parent_stream_name, child_stream_name)
+
+
+# Resumable checkpoints of the parent/child syncs: the last parent id with all of its child
+#   (and descendant) records synced, by top-level parent/child stream pair. Only the children
+#   of the top-level streams are checkpointed: a nested parent id (e.g. a dashboard element)
+#   is only meaningful within its own parent, and the top-level checkpoint already covers the
+#   descendants of its children. Written to the state bookmarks at most every
+#   interval seconds; cleared when the top-level stream is synced. After an interrupted run,
+#   the parents up to the checkpoint are skipped (their records are still synced).
+#   The child requests are planned in parent id order, and parents are compared by id (not by
+#   position), so the resume does not depend on the order of the API response, and it works
+#   across the pages of a paginated parent (requested sorted by id, e.g. users?sorts=id).
+class Checkpoints:
+    def __init__(self, state, interval=CHECKPOINT_INTERVAL_DEFAULT):
+        self.state = state
+        self.interval = interval
+        self.__pending = {}
+        self.__written = time.monotonic()
+
+    # Parent records (a list) with a parent id after the checkpoint parent id
+    def get_remaining(self, key, records, parent_id_field):
+        if not isinstance(records, list):
+            raise TypeError('Checkpoints.get_remaining: records must be a list')
+        last_parent_id = get_bookmark(self.state, key, None)
+        if last_parent_id is None:
+            return records
+        last_sort_key = get_parent_sort_key(last_parent_id)
+        remaining = [record for record in records \
+            if get_parent_sort_key(record.get(parent_id_field)) > last_sort_key]
+        if len(remaining) < len(records):
+            LOGGER.info('{}: resuming after parent_id: {}, skipping {} parents'.format(
+                key, last_parent_id, len(records) - len(remaining)))
+        return remaining
+
+    def completed(self, key, parent_id):
+        self.__pending[key] = parent_id
+        if time.monotonic() - self.__written >= self.interval:
+            self.write()
+
+    def write(self):
+        for key, parent_id in self.__pending.items():
+            write_bookmark(self.state, key, parent_id)
+        self.__pending = {}
+        self.__written = time.monotonic()
+
+    # The stream and its descendants are synced
+    def clear(self, stream_name):
+        self.__pending = {}
+        for parent_stream_name, child_stream_name in STREAM_GRAPH.get_edges(stream_name):
+            self.state.get('bookmarks', {}).pop(
+                get_checkpoint_key(parent_stream_name, child_stream_name), None)
+
+
+# Fetch child endpoints, in order. With an executor, up to max_in_flight requests are
+#   fetched concurrently by the worker threads; records are still processed and written
+#   by the calling (main) thread, one child at a time, in the same order as a serial sync.
+def fetch_children(client, executor, child_requests, max_in_flight):
+    if executor is None:
+        for child_request in child_requests:
+            data = fetch_endpoint(
+                client=client,
+                stream_name=child_request['stream_name'],
+                path=get_page_path(child_request['path'], child_request['endpoint_config'], 0),
+                method=child_request['method'],
+                endpoint_config=child_request['endpoint_config'],
+                stream_json=child_request['stream_json'])
+            yield child_request, data
+        return
+
+    pending = collections.deque()
+    for child_request in child_requests:
+        future = executor.submit(
+            fetch_endpoint,
+            client=client,
+            stream_name=child_request['stream_name'],
+            path=get_page_path(child_request['path'], child_request['endpoint_config'], 0),
+            method=child_request['method'],
+            endpoint_config=child_request['endpoint_config'],
+            stream_json=child_request['stream_json'])
+        pending.append((child_request, future))
+        if len(pending) >= max_in_flight:
+            next_request, next_future = pending.popleft()
+            yield next_request, next_future.result()
+    while pending:
+        next_request, next_future = pending.popleft()
+        yield next_request, next_future.result()
+
+
+# Fetch child requests, up to max_in_flight concurrently (with an executor), and yield them
+#   as they complete, with the fetch duration (seconds)
+def fetch_as_completed(client, executor, child_requests, max_in_flight):
+    # Responses are not streamed: the fetch seconds include the download of the body, and
+    #   a completed fetch does not hold a connection until its response is read
+    def timed_fetch(child_request):
+        started = time.monotonic()
+        data = fetch_endpoint(
+            client=client,
+            stream_name=child_request['stream_name'],
+            path=child_request['path'],
+            method=child_request['method'],
+            endpoint_config=child_request['endpoint_config'],
+            stream_json=False)
+        return data, time.monotonic() - started
+
+    if executor is None:
+        for child_request in child_requests:
+            data, seconds = timed_fetch(child_request)
+            yield child_request, data, seconds
+        return
+
+    remaining = collections.deque(child_requests)
+    pending = {}
+    try:
+        while remaining or pending:
+            while remaining and len(pending) < max_in_flight:
+                child_request = remaining.popleft()
+                pending[executor.submit(timed_fetch, child_request)] = child_request
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                child_request = pending.pop(future)
+                data, seconds = future.result()
+                yield child_request, data, seconds
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# A child endpoint with deferred descendants (or deferred itself)
+def has_deferred_descendants(endpoint_config):
+    if endpoint_config.get('deferred'):
+        return True
+    return any(has_deferred_descendants(child_endpoint_config) \
+        for child_endpoint_config in endpoint_config.get('children', {}).values())
+
+
+# Sync the deferred child requests (explores) of a top-level stream. The requests of all
+#   parents are fetched concurrently, the slowest (fetch seconds in the last run, by path)
+#   first, to shorten the total sync time; new paths are fetched first. Each response is
+#   synced as soon as it is fetched, in completion order, so at most max_in_flight
+#   responses are held in memory.
+def sync_deferred_requests(client,
+                           catalog,
+                           state,
+                           start_date,
+                           deferred_requests,
+                           selected_streams,
+                           executor=None,
+                           max_in_flight=1,
+                           max_bookmarks=None,
+                           record_transforms=None,
+                           record_hashes=None):
+    total_records = 0
+    fetch_seconds = {}
+    for child_stream_name in sorted(set(child_request['stream_name'] \
+            for child_request in deferred_requests)):
+        child_requests = [child_request for child_request in deferred_requests \
+            if child_request['stream_name'] == child_stream_name]
+        seconds_key = '{}__fetch_seconds'.format(child_stream_name)
+        last_seconds = get_bookmark(state, seconds_key, None) or {}
+        child_requests.sort(
+            key=lambda child_request: last_seconds.get(child_request['path'], float('inf')),
+            reverse=True)
+        LOGGER.info('{}: syncing {} deferred requests, slowest first'.format(
+            child_stream_name, len(child_requests)))
+
+        fetch_seconds[seconds_key] = {}
+        for child_request, child_data, seconds in fetch_as_completed(
+                client, executor, child_requests, max_in_flight):
+            child_endpoint_config = child_request['endpoint_config']
+            fetch_seconds[seconds_key][child_request['path']] = round(seconds, 2)
+            total_records = total_records + sync_endpoint_data(
+                client=client,
+                catalog=catalog,
+                state=state,
+                start_date=start_date,
+                stream_name=child_stream_name,
+                path=child_request['path'],
+                endpoint_config=child_endpoint_config,
+                data=child_data,
+                bookmark_field=next(
+                    iter(child_endpoint_config.get('replication_keys', [])), None),
+                id_fields=child_endpoint_config.get('key_properties'),
+                selected_streams=selected_streams,
+                parent=child_endpoint_config.get('parent'),
+                parent_id=child_request['parent_id'],
+                max_bookmarks=max_bookmarks,
+                record_transforms=record_transforms,
+                record_hashes=record_hashes)
+
+    for seconds_key, seconds in fetch_seconds.items():
+        write_bookmark(state, seconds_key, seconds)
+    return total_records
+
+
 # Sync a specific parent or child endpoint.
-def sync_endpoint(client, #pylint: disable=too-many-branches
+def sync_endpoint(client,
                   catalog,
                   state,
                   start_date,
@@ -116,24 +595,91 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
                   id_fields=None,
                   selected_streams=None,
                   parent=None,
-                  parent_id=None):
+                  parent_id=None,
+                  executor=None,
+                  max_in_flight=1,
+                  synced_paths=None,
+                  max_bookmarks=None,
+                  checkpoints=None,
+                  deferred_requests=None,
+                  record_transforms=None,
+                  record_hashes=None,
+                  page_number=0,
+                  stream_responses=False):
 
     LOGGER.info('STARTING Stream: {}'.format(stream_name))
+    # pagination: for endpoints with a page_size, each page is processed before the next request
+    total_records = 0
+    stream_json = is_streamed(stream_name, endpoint_config, selected_streams, stream_responses)
+    while True:
+        page_path = get_page_path(path, endpoint_config, page_number)
+        data = fetch_endpoint(
+            client=client,
+            stream_name=stream_name,
+            path=page_path,
+            method=method,
+            endpoint_config=endpoint_config,
+            stream_json=stream_json)
+
+        total_records = total_records + sync_endpoint_data(
+            client=client,
+            catalog=catalog,
+            state=state,
+            start_date=start_date,
+            stream_name=stream_name,
+            path=page_path,
+            endpoint_config=endpoint_config,
+            data=data,
+            bookmark_field=bookmark_field,
+            id_fields=id_fields,
+            selected_streams=selected_streams,
+            parent=parent,
+            parent_id=parent_id,
+            executor=executor,
+            max_in_flight=max_in_flight,
+            synced_paths=synced_paths,
+            max_bookmarks=max_bookmarks,
+            checkpoints=checkpoints,
+            deferred_requests=deferred_requests,
+            record_transforms=record_transforms,
+            record_hashes=record_hashes,
+            stream_responses=stream_responses)
+
+        if is_last_page(data, endpoint_config):
+            break
+        page_number = page_number + 1
+
+    return total_records
+
+
+# Process the API response data for an endpoint, then sync its children (if selected).
+def sync_endpoint_data(client, #pylint: disable=too-many-branches,too-many-statements
+                       catalog,
+                       state,
+                       start_date,
+                       stream_name,
+                       path,
+                       endpoint_config,
+                       data,
+                       bookmark_field=None,
+                       id_fields=None,
+                       selected_streams=None,
+                       parent=None,
+                       parent_id=None,
+                       executor=None,
+                       max_in_flight=1,
+                       synced_paths=None,
+                       max_bookmarks=None,
+                       checkpoints=None,
+                       deferred_requests=None,
+                       record_transforms=None,
+                       record_hashes=None,
+                       stream_responses=False):
+
     # Get the latest bookmark for the stream and set the last_datetime
     last_datetime = get_bookmark(state, stream_name, start_date)
     max_bookmark_value = last_datetime
-
-    # pagination: there is no pagination for Looker API
     url = '{}/{}'.format(client.base_url, path)
-    LOGGER.info('URL for {}: {}'.format(stream_name, url))
-
-    # Get data, API request
-    body = endpoint_config.get('body')
-    data = client.request(
-        method=method,
-        path=path,
-        endpoint=stream_name,
-        json=body)
 
     # time_extracted: datetime when the data was extracted from the API
     time_extracted = utils.now()
@@ -142,129 +688,351 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
     data_set = [] # initialize the data_set record list
 
     # If data is a single-record dict (like shop endpoint), add it to a list
+    streamed = False
     if isinstance(data, dict):
         data_set.append(data)
     elif isinstance(data, list):
         data_set = data
+    elif isinstance(data, collections.abc.Iterator):
+        # Streamed response: records are parsed, transformed and written one at a time
+        data_set = data
+        streamed = True
     else:
         return 0
 
     # Transform data_set records to transformed_data
-    transformed_data = []
-    records_queried = 0
-    for record in data_set:
-        transformed_record = transform_json(record, stream_name)
-        if transformed_record:
-            transformed_data.append(transformed_record)
-            records_queried = records_queried + 1
-
-    if stream_name == 'models':
-        child_list = []
-        for record in transformed_data:
-            if 'explores' in record:
-                for explore in record['explores']:
-                    explore_name = explore.get('name')
-                    if explore_name:
-                        child_list.append(explore_name)
-        LOGGER.info('child_list: {}'.format(child_list))
-    else:
-        child_list = ['self']
+    stats = {'records_queried': 0}
+    transformed_data = transform_records(data_set, stream_name, stats)
+    # The records of a parent are kept to plan its child requests (even if streamed)
+    children = endpoint_config.get('children')
+    if not streamed or children:
+        transformed_data = list(transformed_data)
 
     # Process records and get the max_bookmark_value and record_count for the set of records
-    max_bookmark_value, records_processed = process_records(
-        catalog=catalog,
-        stream_name=stream_name,
-        records=transformed_data,
-        time_extracted=time_extracted,
-        bookmark_field=bookmark_field,
-        max_bookmark_value=max_bookmark_value,
-        last_datetime=last_datetime,
-        parent=parent,
-        parent_id=parent_id,
-        url=url)
+    #   ID-only parent (not selected, with selected descendants): the records only drive the
+    #   child requests; they are not transformed or written, and there is no bookmark
+    if stream_name in selected_streams:
+        max_bookmark_value, records_processed = process_records(
+            catalog=catalog,
+            stream_name=stream_name,
+            records=transformed_data,
+            time_extracted=time_extracted,
+            bookmark_field=bookmark_field,
+            max_bookmark_value=max_bookmark_value,
+            last_datetime=last_datetime,
+            parent=parent,
+            parent_id=parent_id,
+            url=url,
+            record_transforms=record_transforms,
+            record_hashes=record_hashes)
+    else:
+        max_bookmark_value, records_processed = None, 0
+
+    # Max. bookmark of the stream in this run; written to the state at the end of the sync,
+    #   so the last_datetime stays the same for all parents of a child stream
+    if bookmark_field and max_bookmarks is not None and max_bookmark_value:
+        if max_bookmark_value > max_bookmarks.get(stream_name, ''):
+            max_bookmarks[stream_name] = max_bookmark_value
 
     # Loop thru parent batch records for each children objects (if should stream)
-    children = endpoint_config.get('children')
     if children:
+        parent_id_field = get_parent_id_field(id_fields)
+        # Planning: the child requests of the selected child streams, for all parent records,
+        #   in parent id order (checkpoints)
+        sorted_records = sorted(
+            transformed_data,
+            key=lambda record: get_parent_sort_key(record.get(parent_id_field)))
+        child_plans = []
         for child_stream_name, child_endpoint_config in children.items():
+            if STREAM_GRAPH.has_selected(child_stream_name, selected_streams, stream_name):
+                # Resume: skip the parents completed before the last run was interrupted
+                checkpoint_key = get_checkpoint_key(stream_name, child_stream_name)
+                parent_records = sorted_records
+                if checkpoints is not None:
+                    parent_records = checkpoints.get_remaining(
+                        checkpoint_key, sorted_records, parent_id_field)
+                    # Change detection: the records of the skipped parents are not deleted
+                    if record_hashes is not None and len(parent_records) < len(sorted_records):
+                        for resumed_stream_name in (child_stream_name,) + \
+                            tuple(STREAM_GRAPH.descendants[child_stream_name]):
+                            if resumed_stream_name in selected_streams:
+                                record_hashes.resume_stream(resumed_stream_name)
+
+                child_requests = plan_child_requests(
+                    stream_name=stream_name,
+                    child_stream_name=child_stream_name,
+                    child_endpoint_config=child_endpoint_config,
+                    parent_records=parent_records,
+                    parent_id_field=parent_id_field,
+                    selected_streams=selected_streams,
+                    synced_paths=synced_paths,
+                    stream_responses=stream_responses)
+                child_plans.append((child_stream_name, child_endpoint_config, child_requests))
+        LOGGER.info('{}: planned {} child requests for {} parents: {}'.format(
+            stream_name,
+            sum(len(child_requests) for _, _, child_requests in child_plans),
+            stats['records_queried'],
+            ', '.join('{} = {}'.format(child_stream_name, len(child_requests)) \
+                for child_stream_name, _, child_requests in child_plans)))
+
+        # Execution: fetch and sync the planned child requests
+        for child_stream_name, child_endpoint_config, child_requests in child_plans:
             if child_stream_name in selected_streams:
                 write_schema(catalog, child_stream_name)
-                # For each parent record
-                for record in transformed_data:
-                    i = 0
-                    # Set parent_id
-                    for id_field in id_fields:
-                        if i == 0:
-                            parent_id_field = id_field
-                        if id_field == 'id':
-                            parent_id_field = id_field
-                        i = i + 1
-                    do_pass = True
-                    parent_id = record.get(parent_id_field)
-                    if parent_id:
-                        child_path = child_endpoint_config.get('path').format(str(parent_id))
-                    else:
-                        do_pass = False
-
-                    content_metadata_id = record.get('content_metadata_id')
-                    if content_metadata_id:
-                        child_path = child_path.replace('[content_metadata_id]', \
-                            str(content_metadata_id))
-                    elif child_stream_name in ['content_metadata', 'content_metadata_access']:
-                        do_pass = False
-
-                    query_id = record.get('query_id')
-                    if query_id:
-                        child_path = child_path.replace('[query_id]', str(query_id))
-                    elif child_stream_name == 'queries':
-                        do_pass = False
-
-                    merge_result_id = record.get('merge_result_id')
-                    if merge_result_id:
-                        child_path = child_path.replace('[merge_result_id]', str(merge_result_id))
-                    elif child_stream_name == 'merge_queries':
-                        do_pass = False
-
-                    if not do_pass:
-                        LOGGER.info('{}, PATH does not pass: {}'.format(child_stream_name, \
-                            child_path))
-                    else:
-                        for child in child_list:
-                            if child != 'self':
-                                child_path = child_path.replace('[child_id]', str(child))
-                            LOGGER.info('Syncing: {}, {}, parent_stream: {}, parent_id: {}'.format(
-                                child_stream_name,
-                                child,
-                                stream_name,
-                                parent_id))
-
-                            LOGGER.info('{}, child_path: {}'.format(child_stream_name, child_path))
-                            child_total_records = sync_endpoint(
-                                client=client,
-                                catalog=catalog,
-                                state=state,
-                                start_date=start_date,
-                                stream_name=child_stream_name,
-                                path=child_path,
-                                endpoint_config=child_endpoint_config,
-                                bookmark_field=child_endpoint_config.get('bookmark_field'),
-                                method=child_endpoint_config.get('method', 'GET'),
-                                id_fields=child_endpoint_config.get('key_properties'),
-                                selected_streams=selected_streams,
-                                parent=child_endpoint_config.get('parent'),
-                                parent_id=parent_id)
-                            LOGGER.info('Synced: {}, parent_id: {}, records_processed: {}'.format(
-                                child_stream_name,
-                                parent_id,
-                                child_total_records))
+            # Deferred (explores): fetched after the top-level stream, by sync_deferred_requests
+            if child_endpoint_config.get('deferred') and deferred_requests is not None:
+                deferred_requests.extend(child_requests)
+                continue
+            checkpoint_key = get_checkpoint_key(stream_name, child_stream_name)
+            # Parents with deferred descendants are complete only after the deferred requests
+            child_checkpoints = checkpoints
+            if deferred_requests is not None and has_deferred_descendants(child_endpoint_config):
+                child_checkpoints = None
+            child_bookmark_field = next(
+                iter(child_endpoint_config.get('replication_keys', [])), None)
+            # Child requests not yet synced, by parent_id (checkpoints)
+            parent_requests = collections.Counter(
+                child_request['parent_id'] for child_request in child_requests)
+            for child_request, child_data in fetch_children(
+                    client, executor, child_requests, max_in_flight):
+                LOGGER.info('Syncing: {}, {}, parent_stream: {}, parent_id: {}'.format(
+                    child_stream_name,
+                    child_request['child'],
+                    stream_name,
+                    child_request['parent_id']))
+
+                LOGGER.info('{}, child_path: {}'.format(child_stream_name, \
+                    child_request['path']))
+                child_total_records = sync_endpoint_data(
+                    client=client,
+                    catalog=catalog,
+                    state=state,
+                    start_date=start_date,
+                    stream_name=child_stream_name,
+                    path=get_page_path(child_request['path'], child_endpoint_config, 0),
+                    endpoint_config=child_endpoint_config,
+                    data=child_data,
+                    bookmark_field=child_bookmark_field,
+                    id_fields=child_endpoint_config.get('key_properties'),
+                    selected_streams=selected_streams,
+                    parent=child_endpoint_config.get('parent'),
+                    parent_id=child_request['parent_id'],
+                    executor=executor,
+                    max_in_flight=max_in_flight,
+                    synced_paths=synced_paths,
+                    max_bookmarks=max_bookmarks,
+                    checkpoints=None,
+                    deferred_requests=deferred_requests,
+                    record_transforms=record_transforms,
+                    record_hashes=record_hashes,
+                    stream_responses=stream_responses)
+                # Next pages of the child endpoint (first page fetched above)
+                if not is_last_page(child_data, child_endpoint_config):
+                    child_total_records = child_total_records + sync_endpoint(
+                        client=client,
+                        catalog=catalog,
+                        state=state,
+                        start_date=start_date,
+                        stream_name=child_stream_name,
+                        path=child_request['path'],
+                        method=child_request['method'],
+                        endpoint_config=child_endpoint_config,
+                        bookmark_field=child_bookmark_field,
+                        id_fields=child_endpoint_config.get('key_properties'),
+                        selected_streams=selected_streams,
+                        parent=child_endpoint_config.get('parent'),
+                        parent_id=child_request['parent_id'],
+                        executor=executor,
+                        max_in_flight=max_in_flight,
+                        synced_paths=synced_paths,
+                        max_bookmarks=max_bookmarks,
+                        checkpoints=None,
+                        deferred_requests=deferred_requests,
+                        record_transforms=record_transforms,
+                        record_hashes=record_hashes,
+                        page_number=1,
+                        stream_responses=stream_responses)
+                LOGGER.info('Synced: {}, parent_id: {}, records_processed: {}'.format(
+                    child_stream_name,
+                    child_request['parent_id'],
+                    child_total_records))
+                # All child requests of the parent are synced
+                parent_requests[child_request['parent_id']] -= 1
+                if child_checkpoints is not None and \
+                    not parent_requests[child_request['parent_id']]:
+                    child_checkpoints.completed(checkpoint_key, child_request['parent_id'])
 
     LOGGER.info('{}: records_queried = {}, records_processed = {}'.format(
-        stream_name, records_queried, records_processed))
+        stream_name, stats['records_queried'], records_processed))
     # Return the list of ids to the stream, in case this is a parent stream with children.
     LOGGER.info('FINISHING Stream: {}'.format(stream_name))
     return records_processed
 
 
+# Date windows [start, end) of window_days, from start_datetime through today
+def get_date_windows(start_datetime, window_days):
+    window_start = strptime_to_utc(start_datetime).date()
+    tomorrow = utils.now().date() + timedelta(days=1)
+    windows = []
+    while window_start < tomorrow:
+        window_end = min(window_start + timedelta(days=window_days), tomorrow)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+
+# Run the inline query (e.g. query_history) for a date window, filtered on bookmark_query_field.
+#   If the row_limit is reached, the rows of the last value of the first sort field (query.id),
+#   which may be incomplete, are dropped and the window is queried again from that value.
+#   The aggregated rows for a query id and date are never split. If the rows of a single value
+#   reach the row_limit, they are truncated and the window is queried again after that value.
+def fetch_query_window(client, stream_name, endpoint_config, window_start, window_end):
+    path = endpoint_config.get('path', stream_name)
+    row_limit = endpoint_config.get('row_limit')
+    if row_limit:
+        path = '{}&limit={}'.format(path, row_limit)
+    split_field = next(iter(endpoint_config.get('body', {}).get('sorts', [])), None)
+
+    rows = []
+    split_filter = None
+    while True:
+        body = copy.deepcopy(endpoint_config.get('body', {}))
+        body['filters'][endpoint_config.get('bookmark_query_field')] = '{} to {}'.format(
+            window_start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d'))
+        if split_filter is not None:
+            body['filters'][split_field] = split_filter
+        data = fetch_endpoint(
+            client=client,
+            stream_name=stream_name,
+            path=path,
+            method=endpoint_config.get('method', 'GET'),
+            endpoint_config=dict(endpoint_config, body=body))
+        if not isinstance(data, list):
+            break
+        if not row_limit or len(data) < row_limit:
+            rows.extend(data)
+            break
+
+        last_value = data[-1].get(split_field)
+        complete_rows = [row for row in data if row.get(split_field) != last_value]
+        if not split_field or not complete_rows:
+            LOGGER.warning('{}: row_limit {} reached for {} = {}, window {} to {}; ' \
+                'rows are truncated'.format(
+                    stream_name, row_limit, split_field, last_value, window_start, window_end))
+            rows.extend(data)
+            if not split_field:
+                break
+            split_filter = '>{}'.format(last_value)
+            continue
+        LOGGER.info('{}: row_limit {} reached, window {} to {}; querying again from {} = {}'.format(
+            stream_name, row_limit, window_start, window_end, split_field, last_value))
+        rows.extend(complete_rows)
+        split_filter = '>={}'.format(last_value)
+    return rows
+
+
+# Fetch the date windows of an inline query endpoint, in order. With an executor, up to
+#   max_in_flight windows are queried concurrently; the rows are yielded window by window,
+#   in window order, so a window is only processed after all of the previous windows.
+def fetch_query_windows(client, executor, stream_name, endpoint_config, windows, max_in_flight):
+    if executor is None:
+        for window_start, window_end in windows:
+            yield window_start, window_end, fetch_query_window(
+                client, stream_name, endpoint_config, window_start, window_end)
+        return
+
+    pending = collections.deque()
+    try:
+        for window_start, window_end in windows:
+            future = executor.submit(
+                fetch_query_window,
+                client, stream_name, endpoint_config, window_start, window_end)
+            pending.append((window_start, window_end, future))
+            if len(pending) >= max_in_flight:
+                next_start, next_end, next_future = pending.popleft()
+                yield next_start, next_end, next_future.result()
+        while pending:
+            next_start, next_end, next_future = pending.popleft()
+            yield next_start, next_end, next_future.result()
+    finally:
+        # On error, do not start the windows not yet running
+        for _, _, future in pending:
+            future.cancel()
+
+
+# Sync an INCREMENTAL inline query endpoint (bookmark_query_field) in date windows,
+#   from the bookmark (or start_date) to now. With window_workers > 1, the windows are
+#   queried concurrently. The bookmark is written after each window, once it and all of the
+#   previous windows are complete; it never passes today, so the current (incomplete) day
+#   is synced again in the next run.
+def sync_query_windows(client,
+                       catalog,
+                       state,
+                       start_date,
+                       stream_name,
+                       endpoint_config,
+                       window_days=1,
+                       window_workers=1,
+                       selected_streams=None,
+                       record_transforms=None):
+    LOGGER.info('STARTING Stream: {}'.format(stream_name))
+    bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+    last_datetime = get_bookmark(state, stream_name, start_date)
+    today = utils.now().date()
+    windows = get_date_windows(last_datetime, window_days)
+    LOGGER.info('{}: {} windows of {} days, {} workers'.format(
+        stream_name, len(windows), window_days, window_workers))
+
+    executor = None
+    if window_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=window_workers)
+    total_records = 0
+    try:
+        for window_start, window_end, rows in fetch_query_windows(
+                client, executor, stream_name, endpoint_config, windows, window_workers * 2):
+            LOGGER.info('{}: window {} to {}, {} rows'.format(
+                stream_name, window_start, window_end, len(rows)))
+            total_records = total_records + sync_endpoint_data(
+                client=client,
+                catalog=catalog,
+                state=state,
+                start_date=start_date,
+                stream_name=stream_name,
+                path=endpoint_config.get('path', stream_name),
+                endpoint_config=endpoint_config,
+                data=rows,
+                bookmark_field=bookmark_field,
+                id_fields=endpoint_config.get('key_properties'),
+                selected_streams=selected_streams,
+                record_transforms=record_transforms)
+            write_bookmark(
+                state, stream_name, min(window_end, today).strftime('%Y-%m-%dT00:00:00Z'))
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+    return total_records
+
+
+# Tombstones (emit_tombstones config): records of the last run not seen in this run are
+#   written with their key properties and _sdc_deleted_at, after a SCHEMA message adding
+#   _sdc_deleted_at to the stream schema.
+def write_tombstones(catalog, record_hashes):
+    deleted_at = utils.strftime(utils.now())
+    for stream_name, deleted_keys in record_hashes.get_deleted_keys().items():
+        stream = catalog.get_stream(stream_name)
+        schema = stream.schema.to_dict()
+        schema['properties']['_sdc_deleted_at'] = {
+            'type': ['null', 'string'],
+            'format': 'date-time'}
+        MESSAGE_WRITER.write_schema(stream_name, schema, stream.key_properties)
+        for key_values in deleted_keys:
+            record = dict(zip(stream.key_properties, key_values))
+            record['_sdc_deleted_at'] = deleted_at
+            MESSAGE_WRITER.write_record(stream_name, record)
+        LOGGER.info('{}: deleted records (tombstones) = {}'.format(
+            stream_name, len(deleted_keys)))
+
+
 # Currently syncing sets the stream currently being delivered in the state.
 # If the integration is interrupted, this state property is used to identify
 #  the starting point to continue from.
@@ -274,7 +1042,7 @@ def update_currently_syncing(state, stream_name):
         del state['currently_syncing']
     else:
         singer.set_currently_syncing(state, stream_name)
-    singer.write_state(state)
+    MESSAGE_WRITER.write_state(state)
 
 
 # List selected fields from stream catalog
@@ -309,30 +1077,143 @@ def sync(client, config, catalog, state):
     if not selected_streams:
         return
 
-    # Loop through selected_streams
-    for stream_name, endpoint_config in STREAMS.items():
-        if stream_name in selected_streams:
-            LOGGER.info('START Syncing: {}'.format(stream_name))
-            selected_fields = get_selected_fields(catalog, stream_name)
-            LOGGER.info('Stream: {}, selected_fields: {}'.format(stream_name, selected_fields))
-            update_currently_syncing(state, stream_name)
-            path = endpoint_config.get('path', stream_name)
-            bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
-            write_schema(catalog, stream_name)
-            total_records = sync_endpoint(
-                client=client,
-                catalog=catalog,
-                state=state,
-                start_date=start_date,
-                stream_name=stream_name,
-                path=path,
-                endpoint_config=endpoint_config,
-                method=endpoint_config.get('method', 'GET'),
-                bookmark_field=bookmark_field,
-                id_fields=endpoint_config.get('key_properties'),
-                selected_streams=selected_streams)
+    # Buffer record messages; flushed before schema and state messages
+    MESSAGE_WRITER.configure(
+        buffer_size=config.get('record_buffer_size'),
+        flush_interval=config.get('record_flush_interval'),
+        fast_json=config.get('fast_json_encoder', False))
+
+    # Compile the record transforms for the selected streams once, for all records
+    record_transforms = {}
+    for stream_name in selected_streams:
+        record_transforms[stream_name] = compile_stream_transform(catalog, stream_name)
+
+    # Fetch child endpoints concurrently with max_workers threads (default: 1, serial)
+    max_workers = int(config.get('max_workers', 1))
+    executor = None
+    if max_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Limit the number of fetched, but not yet processed, child responses held in memory
+    max_in_flight = max_workers * 2
+    # Shared child (stream, path) pairs synced in this run, with the number of times planned
+    synced_paths = collections.Counter()
+    # Max. bookmark values of the INCREMENTAL streams, by stream
+    max_bookmarks = {}
+    # Deferred child requests (explores) of the current top-level stream
+    deferred_requests = []
+    # Resumable parent/child checkpoints
+    checkpoints = Checkpoints(
+        state, float(config.get('checkpoint_interval', CHECKPOINT_INTERVAL_DEFAULT)))
+    # Change detection: emit only the records changed since the last run
+    record_hashes = None
+    if config.get('record_hashes_path'):
+        record_hashes = RecordHashes(config.get('record_hashes_path'), state)
+
+    # Streams with selected streams in their subtree; request only the selected fields
+    #   (field_projection, default: true)
+    sync_streams = get_sync_streams(
+        catalog, selected_streams, field_projection=config.get('field_projection', True))
+
+    try:
+        # Loop through the top-level streams with selected streams in their subtree;
+        #   unselected parents are synced ID-only, for the child requests of their descendants
+        for stream_name, endpoint_config in sync_streams.items():
+            if stream_name in selected_streams or endpoint_config.get('children'):
+                if stream_name in selected_streams:
+                    LOGGER.info('START Syncing: {}'.format(stream_name))
+                    selected_fields = get_selected_fields(catalog, stream_name)
+                    LOGGER.info('Stream: {}, selected_fields: {}'.format(
+                        stream_name, selected_fields))
+                    write_schema(catalog, stream_name)
+                else:
+                    LOGGER.info('START Syncing: {} (ID-only parent), fields: {}'.format(
+                        stream_name, endpoint_config.get('fields')))
+                update_currently_syncing(state, stream_name)
+                path = endpoint_config.get('path', stream_name)
+                bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+                if endpoint_config.get('bookmark_query_field'):
+                    total_records = sync_query_windows(
+                        client=client,
+                        catalog=catalog,
+                        state=state,
+                        start_date=start_date,
+                        stream_name=stream_name,
+                        endpoint_config=endpoint_config,
+                        window_days=int(config.get('query_window_days', 1)),
+                        window_workers=int(config.get('query_window_workers', 1)),
+                        selected_streams=selected_streams,
+                        record_transforms=record_transforms)
+                    update_currently_syncing(state, None)
+                    LOGGER.info('FINISHED Syncing: {}, total_records: {}'.format(
+                        stream_name,
+                        total_records))
+                    continue
+                total_records = sync_endpoint(
+                    client=client,
+                    catalog=catalog,
+                    state=state,
+                    start_date=start_date,
+                    stream_name=stream_name,
+                    path=path,
+                    endpoint_config=endpoint_config,
+                    method=endpoint_config.get('method', 'GET'),
+                    bookmark_field=bookmark_field,
+                    id_fields=endpoint_config.get('key_properties'),
+                    selected_streams=selected_streams,
+                    executor=executor,
+                    max_in_flight=max_in_flight,
+                    synced_paths=synced_paths,
+                    max_bookmarks=max_bookmarks,
+                    checkpoints=checkpoints,
+                    deferred_requests=deferred_requests,
+                    record_transforms=record_transforms,
+                    record_hashes=record_hashes,
+                    stream_responses=config.get('stream_responses', False))
+
+                if deferred_requests:
+                    total_records = total_records + sync_deferred_requests(
+                        client=client,
+                        catalog=catalog,
+                        state=state,
+                        start_date=start_date,
+                        deferred_requests=deferred_requests,
+                        selected_streams=selected_streams,
+                        executor=executor,
+                        max_in_flight=max_in_flight,
+                        max_bookmarks=max_bookmarks,
+                        record_transforms=record_transforms,
+                        record_hashes=record_hashes)
+                    deferred_requests.clear()
+
+                checkpoints.clear(stream_name)
+                update_currently_syncing(state, None)
+                LOGGER.info('FINISHED Syncing: {}, total_records: {}'.format(
+                    stream_name,
+                    total_records))
+
+        # Shared child paths: requests saved by syncing each path once per run, by stream
+        shared_requests = collections.Counter()
+        shared_paths = collections.Counter()
+        for (child_stream_name, _), planned in synced_paths.items():
+            shared_requests[child_stream_name] += planned
+            shared_paths[child_stream_name] += 1
+        for child_stream_name, planned in shared_requests.items():
+            LOGGER.info('{}: shared child paths = {}, repeated requests not sent = {}'.format(
+                child_stream_name,
+                shared_paths[child_stream_name],
+                planned - shared_paths[child_stream_name]))
+
+        # Bookmarks of the INCREMENTAL streams, after all streams (and their parents) are synced
+        for stream_name, max_bookmark_value in max_bookmarks.items():
+            write_bookmark(state, stream_name, max_bookmark_value)
 
-            update_currently_syncing(state, None)
-            LOGGER.info('FINISHED Syncing: {}, total_records: {}'.format(
-                stream_name,
-                total_records))
+        if record_hashes:
+            if config.get('emit_tombstones', False):
+                write_tombstones(catalog, record_hashes)
+            MESSAGE_WRITER.flush()
+            record_hashes.save(state)
+            MESSAGE_WRITER.write_state(state)
+    finally:
+        MESSAGE_WRITER.flush()
+        if executor:
+            executor.shutdown(wait=True)
@@ -1,33 +1,61 @@
+import copy
+import functools
 import numbers
 import hashlib
 import singer
+from singer import Transformer
+from singer.transform import string_to_datetime
 
 LOGGER = singer.get_logger()
 
+# Returned by compiled record transforms when a value does not match its schema
+TRANSFORM_FAILED = object()
+
 # TRANSFORM JSON SCHEMAS: Looker Swagger to Singer.io JSON Schema
 # Loop through and replace $ref references in nested dict and lists
-def replace_refs(this_dict, swagger):
-    for k, v in list(this_dict.items()):
-        if k == 'properties' and isinstance(this_dict, dict):
-            this_dict['additionalProperties'] = False
-            this_dict['type'] = ['null', 'object']
+#   Returns a new dict; this_dict and the swagger definitions are NOT modified.
+#   resolved_refs: cache of resolved swagger definitions, by definition name; may be shared
+#       by all streams. Cached definitions are shared by the returned dicts, copy before modifying.
+#   resolving: definitions currently being resolved, to detect circular references
+def replace_refs(this_dict, swagger, resolved_refs=None, resolving=None):
+    if resolved_refs is None:
+        resolved_refs = {}
+    if resolving is None:
+        resolving = set()
+    new_dict = {}
+    for k, v in this_dict.items():
         if isinstance(v, dict):
-            is_nested_ref = False
-            for key, val in list(v.items()):
-                # If dict has nested $ref elements, replace those with the related swagger obj
-                if key == '$ref':
-                    is_nested_ref = True
-                    obj = val.replace('#/definitions/', '')
-                    new_v = replace_refs(swagger.get('definitions', {}).get(obj, {}), swagger)
-            if is_nested_ref:
-                # Replace parent node with nested reference node
-                this_dict[k] = new_v
-            replace_refs(v, swagger)
+            # If dict has nested $ref elements, replace those with the related swagger obj
+            if '$ref' in v:
+                new_dict[k] = resolve_ref(v['$ref'], swagger, resolved_refs, resolving)
+            else:
+                new_dict[k] = replace_refs(v, swagger, resolved_refs, resolving)
         elif isinstance(v, list):
-            for i in list(v):
-                if isinstance(i, dict):
-                    replace_refs(i, swagger)
-    return this_dict
+            new_dict[k] = [replace_refs(i, swagger, resolved_refs, resolving) \
+                if isinstance(i, dict) else i for i in v]
+        else:
+            new_dict[k] = v
+    if 'properties' in this_dict:
+        new_dict['additionalProperties'] = False
+        new_dict['type'] = ['null', 'object']
+    return new_dict
+
+
+# Resolve a $ref (#/definitions/<obj>) to the swagger definition, with its nested refs replaced.
+#   Each definition is resolved once; circular references become an untyped object.
+def resolve_ref(ref, swagger, resolved_refs, resolving):
+    obj = ref.replace('#/definitions/', '')
+    if obj in resolved_refs:
+        return resolved_refs[obj]
+    if obj in resolving:
+        LOGGER.warning('Circular $ref to swagger definition: {}'.format(obj))
+        return {'type': ['null', 'object'], 'additionalProperties': True}
+    resolving.add(obj)
+    resolved = replace_refs(
+        swagger.get('definitions', {}).get(obj, {}), swagger, resolved_refs, resolving)
+    resolving.discard(obj)
+    resolved_refs[obj] = resolved
+    return resolved
 
 
 # Convert type fields from single value to arrays, change IDs to strings,
@@ -84,12 +112,14 @@ def tranform_looker_schemas(this_dict):
 
 
 # Create a Singer JSON Schema from Looker Swagger endpoint
-def get_transform_schema(client, stream_swagger_object, stream_name):
+#   swagger: Looker Swagger API document (swagger.json), loaded once for all streams
+#   resolved_refs: cache of resolved swagger definitions, shared by all streams
+def get_transform_schema(swagger, stream_swagger_object, stream_name, resolved_refs=None):
     LOGGER.info('Starting transform: {}'.format(stream_name))
-    endpoint = 'swagger.json'
-    swagger = client.request(method='GET', path=endpoint, endpoint=endpoint)
     schema = swagger.get('definitions', {}).get(stream_swagger_object, {})
-    new_schema = tranform_looker_schemas(replace_refs(schema, swagger))
+    # The transforms below modify the schema in place; copy the (shared) resolved definitions
+    new_schema = tranform_looker_schemas(copy.deepcopy(
+        replace_refs(schema, swagger, resolved_refs)))
 
     # Fix issue with ui_cofig and field for DashboardFilter
     if stream_name == 'dashboard_filters':
@@ -223,22 +253,39 @@ def hash_data(data):
     return hashId.hexdigest()
 
 
+# query_history: measures and keys; the other (dimension) columns are hashed to dims_hash_key
+QUERY_HISTORY_NON_DIMS = (
+    'query_id', 'history_created_date', 'history_query_run_count', 'history_total_runtime')
+
+
+# query_history: column mapping for the columns (keys) of a query response, built once per
+#   set of columns: (key, new_key with decimals replaced by underscores, is_dimension)
+@functools.lru_cache(maxsize=32)
+def get_query_history_columns(keys):
+    columns = []
+    for key in keys:
+        new_key = key.replace('.', '_')
+        columns.append((key, new_key, new_key not in QUERY_HISTORY_NON_DIMS))
+    return tuple(columns)
+
+
 # query_history: Replace decimals with underscores in key
+#   dims_hash_key: hash of the sorted dimension values (or the column name, for empty values);
+#   computed once per row, the same value as previous versions.
 def transform_query_history(this_json):
-    new_json = this_json
+    new_json = {}
     dim_vals = []
-    for key, val in list(new_json.items()):
-        new_key = key.replace('.', '_')
+    for key, new_key, is_dim in get_query_history_columns(tuple(this_json)):
+        val = this_json[key]
         new_json[new_key] = val
-        new_json.pop(key, None)
-        if new_key not in ('query_id', 'history_created_date', 'history_query_run_count', 'history_total_runtime'):
+        if is_dim:
             if not val:
-                new_val = key
+                dim_vals.append(key)
             else:
-                new_val = '{}'.format(val)
-            dim_vals.append(new_val)
-        dims_hash_key = str(hash_data(sorted(dim_vals)))
-        new_json['dims_hash_key'] = dims_hash_key
+                dim_vals.append('{}'.format(val))
+    if new_json:
+        dim_vals.sort()
+        new_json['dims_hash_key'] = hash_data(dim_vals)
     return new_json
 
 
@@ -269,9 +316,10 @@ def ids_to_string(this_dict):
     return this_dict
 
 
-# Run other transforms, as needed: denest_list_nodes, transform_conversation_parts
+# Run stream-specific transforms, as needed. Removing can nodes, IDs to string, and removing
+#   null values are done by the compiled record transform (compile_record_transform).
 def transform_json(this_json, stream_name):
-    uncanny_json = remove_can_nodes(this_json)
+    uncanny_json = this_json
     adjusted_json = None
     if stream_name == 'dashboards':
         # Remove LookML Dashboards
@@ -293,6 +341,187 @@ def transform_json(this_json, stream_name):
         adjusted_json = transform_query_history(uncanny_json)
     else:
         adjusted_json = uncanny_json
-    transformed_json = ids_to_string(adjusted_json)
 
-    return transformed_json
+    return adjusted_json
+
+
+# Remove can nodes and convert IDs to strings in a value with no schema (no type or properties)
+def clean_json(this_json):
+    if isinstance(this_json, dict):
+        ids_to_string(remove_can_nodes(this_json))
+    elif isinstance(this_json, list):
+        for i in this_json:
+            if isinstance(i, dict):
+                ids_to_string(remove_can_nodes(i))
+    return this_json
+
+
+# Compile a transform function for a single JSON schema type (see singer Transformer._transform)
+#   excluded_fields: object properties to remove (e.g. unselected fields)
+def compile_type_transform(typ, #pylint: disable=too-many-return-statements
+                           schema,
+                           excluded_fields=()):
+    if typ == 'null':
+        def transform_null(data):
+            if data is None or data == '':
+                return None
+            return TRANSFORM_FAILED
+        return transform_null
+
+    if schema.get('format') == 'date-time':
+        def transform_datetime(data):
+            if data is None or data == '':
+                return TRANSFORM_FAILED
+            new_data = string_to_datetime(data)
+            if new_data is None:
+                return TRANSFORM_FAILED
+            return new_data
+        return transform_datetime
+
+    if typ == 'object':
+        properties = schema.get('properties', {})
+        # Objects without properties are not typed, only cleaned
+        if not properties:
+            def transform_any_object(data):
+                if not isinstance(data, dict):
+                    return TRANSFORM_FAILED
+                return clean_json(data)
+            return transform_any_object
+
+        # key: (transform, is ID field, is value/count field)
+        property_transforms = {}
+        for key, sub_schema in properties.items():
+            if key != 'can' and key not in excluded_fields:
+                property_transforms[key] = (
+                    compile_schema_transform(sub_schema),
+                    key == 'id' or key.endswith('_id'),
+                    key in ('value', 'count'))
+
+        def transform_object(data):
+            if not isinstance(data, dict):
+                return TRANSFORM_FAILED
+            result = {}
+            for key, val in data.items():
+                # Remove null values and keys not in the schema (including can nodes)
+                if val is None or key not in property_transforms:
+                    continue
+                transform, is_id, is_value = property_transforms[key]
+                # Convert ID, value, count fields to strings
+                if (is_id and isinstance(val, int)) or \
+                    (is_value and isinstance(val, numbers.Number)):
+                    val = str('{}'.format(val))
+                new_val = transform(val)
+                if new_val is TRANSFORM_FAILED:
+                    return TRANSFORM_FAILED
+                result[key] = new_val
+            return result
+        return transform_object
+
+    if typ == 'array':
+        transform_item = compile_schema_transform(schema.get('items', {}))
+
+        def transform_array(data):
+            if not isinstance(data, list):
+                return TRANSFORM_FAILED
+            result = []
+            for item in data:
+                new_item = transform_item(item)
+                if new_item is TRANSFORM_FAILED:
+                    return TRANSFORM_FAILED
+                result.append(new_item)
+            return result
+        return transform_array
+
+    if typ == 'string':
+        def transform_string(data):
+            if data is None:
+                return TRANSFORM_FAILED
+            return str(clean_json(data))
+        return transform_string
+
+    if typ in ('integer', 'number'):
+        to_number = int if typ == 'integer' else float
+
+        def transform_number(data):
+            if isinstance(data, str):
+                data = data.replace(',', '')
+            try:
+                return to_number(data)
+            except (TypeError, ValueError, OverflowError):
+                return TRANSFORM_FAILED
+        return transform_number
+
+    if typ == 'boolean':
+        def transform_boolean(data):
+            if isinstance(data, str) and data.lower() == 'false':
+                return False
+            return bool(clean_json(data))
+        return transform_boolean
+
+    return lambda data: TRANSFORM_FAILED
+
+
+# Compile a transform function for a JSON schema node; types are tried in order, null last
+def compile_schema_transform(schema, excluded_fields=()):
+    if 'anyOf' in schema or 'patternProperties' in schema:
+        # Not used by the Looker schemas; use the singer Transformer
+        def transform_other(data):
+            success, new_data = Transformer().transform_recur(clean_json(data), schema, [])
+            if not success:
+                return TRANSFORM_FAILED
+            return new_data
+        return transform_other
+
+    if 'type' not in schema:
+        return clean_json
+
+    types = schema['type']
+    if not isinstance(types, list):
+        types = [types]
+    types = [typ for typ in types if typ != 'null'] + [typ for typ in types if typ == 'null']
+    transforms = [compile_type_transform(typ, schema, excluded_fields) for typ in types]
+    if len(transforms) == 1:
+        return transforms[0]
+
+    def transform_types(data):
+        for transform in transforms:
+            new_data = transform(data)
+            if new_data is not TRANSFORM_FAILED:
+                return new_data
+        return TRANSFORM_FAILED
+    return transform_types
+
+
+# Fields not selected (selected = False) or unsupported, from the stream metadata map
+def get_excluded_fields(stream_metadata):
+    excluded_fields = set()
+    for breadcrumb, field_metadata in stream_metadata.items():
+        if len(breadcrumb) != 2 or field_metadata.get('inclusion') == 'automatic':
+            continue
+        if field_metadata.get('selected') is False or \
+            field_metadata.get('inclusion') == 'unsupported':
+            excluded_fields.add(breadcrumb[1])
+    return excluded_fields
+
+
+# Compile a single-pass record transform for a stream from its catalog schema and metadata.
+#   In one traversal: remove can nodes, IDs to string, remove null values, remove unselected
+#   and unsupported fields, and transform values to the schema types (like singer Transformer).
+#   Compile once per stream and reuse the returned function for every record.
+def compile_record_transform(schema, stream_metadata):
+    excluded_fields = get_excluded_fields(stream_metadata)
+    # Field selection: unselected fields are left out of the compiled properties
+    transform_schema = compile_schema_transform(schema, excluded_fields)
+
+    def transform_record(record):
+        transformed_record = transform_schema(record)
+        if transformed_record is TRANSFORM_FAILED:
+            # Re-run the multi-pass transforms, which raise SchemaMismatch with the error paths
+            with Transformer() as transformer:
+                transformed_record = transformer.transform(
+                    ids_to_string(remove_can_nodes(record)),
+                    copy.deepcopy(schema),
+                    stream_metadata)
+        return transformed_record
+
+    return transform_record
@@ -0,0 +1,98 @@
+import sys
+import time
+import singer
+from singer import messages
+
+try:
+    # Optional faster JSON encoder (extra: pip install tap-looker[orjson]), used only when
+    #   the fast_json_encoder config is true
+    import orjson
+except ImportError:
+    orjson = None
+
+LOGGER = singer.get_logger()
+
+BUFFER_SIZE_DEFAULT = 64 * 1024 # bytes
+FLUSH_INTERVAL_DEFAULT = 1.0 # seconds
+
+
+# fast_json: serialize with orjson (compact, UTF-8); values orjson would serialize differently
+#   from singer (Decimal, datetime, integers larger than 64 bits) fall back to singer
+def format_message(message, fast_json=False):
+    if fast_json:
+        try:
+            return orjson.dumps(
+                message.asdict(), option=orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+        except TypeError:
+            pass
+    return messages.format_message(message)
+
+
+# Buffered Singer message writer.
+#   RECORD messages are serialized and written to stdout in batches, when buffer_size bytes
+#   are buffered or flush_interval seconds have passed. SCHEMA and STATE messages flush the
+#   buffered records first, so the message order is preserved. The streams with a SCHEMA
+#   message written in the run (configure) are tracked (has_schema).
+class MessageWriter:
+    def __init__(self, buffer_size=BUFFER_SIZE_DEFAULT, flush_interval=FLUSH_INTERVAL_DEFAULT):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fast_json = False
+        self.__schema_streams = set()
+        self.__buffer = []
+        self.__buffered_size = 0
+        self.__last_flush = time.monotonic()
+
+    def configure(self, buffer_size=None, flush_interval=None, fast_json=False):
+        self.flush()
+        self.__schema_streams = set()
+        if buffer_size is None:
+            buffer_size = BUFFER_SIZE_DEFAULT
+        if flush_interval is None:
+            flush_interval = FLUSH_INTERVAL_DEFAULT
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        if fast_json and orjson is None:
+            raise Exception('fast_json_encoder requires orjson: pip install tap-looker[orjson]')
+        self.fast_json = bool(fast_json)
+
+    def write_record(self, stream_name, record, time_extracted=None):
+        line = format_message(messages.RecordMessage(
+            stream=stream_name,
+            record=record,
+            time_extracted=time_extracted), self.fast_json)
+        self.__buffer.append(line)
+        self.__buffer.append('\n')
+        self.__buffered_size = self.__buffered_size + len(line) + 1
+        if self.__buffered_size >= self.buffer_size or \
+            time.monotonic() - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    def has_schema(self, stream_name):
+        return stream_name in self.__schema_streams
+
+    def write_schema(self, stream_name, schema, key_properties):
+        self.flush()
+        singer.write_schema(stream_name, schema, key_properties)
+        self.__schema_streams.add(stream_name)
+
+    def write_state(self, state):
+        self.flush()
+        singer.write_state(state)
+
+    def flush(self):
+        if self.__buffer:
+            try:
+                sys.stdout.write(''.join(self.__buffer))
+                sys.stdout.flush()
+            except OSError as err:
+                LOGGER.info('OS Error writing {} buffered bytes of records'.format(
+                    self.__buffered_size))
+                raise err
+            finally:
+                self.__buffer = []
+                self.__buffered_size = 0
+        self.__last_flush = time.monotonic()
+
+
+MESSAGE_WRITER = MessageWriter()
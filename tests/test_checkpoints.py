@@ -0,0 +1,78 @@
+import contextlib
+import io
+import json
+import re
+import sys
+import unittest
+from singer.catalog import Catalog
+from tap_looker.discover import discover
+from tap_looker.sync import sync
+
+SYNC_MODULE = sys.modules['tap_looker.sync']
+
+
+def get_catalog(stream_names):
+    catalog = discover().to_dict()
+    for stream in catalog['streams']:
+        if stream['stream'] in stream_names:
+            for mdata in stream['metadata']:
+                mdata['metadata']['selected'] = True
+    return Catalog.from_dict(catalog)
+
+
+# Dashboards 5 and 7; the elements of dashboard 7 have lower ids than those of dashboard 5
+class FakeClient:
+    base_url = 'https://test.looker.com:19999/api/3.1'
+
+    def __init__(self):
+        self.paths = []
+
+    def request(self, method, path=None, **kwargs): # pylint: disable=unused-argument
+        self.paths.append(path)
+        path = path.split('?')[0]
+        if path == 'dashboards/search':
+            return [{'id': 5}, {'id': 7}]
+        match = re.match(r'dashboards/(\d+)/dashboard_elements$', path)
+        if match:
+            elements = {'5': [100, 101], '7': [50]}[match.group(1)]
+            return [{'id': element_id, 'query_id': element_id * 10} \
+                for element_id in elements]
+        match = re.match(r'queries/(\d+)$', path)
+        if match:
+            return {'id': int(match.group(1))}
+        return []
+
+
+class TestCheckpoints(unittest.TestCase):
+    def run_sync(self, client, state):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            sync(client=client,
+                 config={'start_date': '2020-01-01T00:00:00Z', 'checkpoint_interval': 0},
+                 catalog=get_catalog(['dashboards', 'dashboard_elements', 'queries']),
+                 state=state)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_children_with_non_monotonic_ids_are_synced(self):
+        client = FakeClient()
+        messages = self.run_sync(client, {})
+        query_ids = sorted(message['record']['id'] for message in messages \
+            if message['type'] == 'RECORD' and message['stream'] == 'queries')
+        self.assertEqual(query_ids, ['1000', '1010', '500'])
+        self.assertIn('queries/500', client.paths)
+
+    def test_resume_skips_completed_top_level_parents_only(self):
+        client = FakeClient()
+        self.run_sync(client, {'bookmarks': {'dashboards__dashboard_elements': 5}})
+        self.assertNotIn('dashboards/5/dashboard_elements', client.paths)
+        self.assertIn('dashboards/7/dashboard_elements', client.paths)
+        self.assertIn('queries/500', client.paths)
+
+    def test_get_remaining_compares_parent_ids(self):
+        checkpoints = SYNC_MODULE.Checkpoints({'bookmarks': {'a__b': 9}})
+        records = [{'id': 2}, {'id': 9}, {'id': 10}]
+        self.assertEqual(checkpoints.get_remaining('a__b', records, 'id'), [{'id': 10}])
+
+
+if __name__ == '__main__':
+    unittest.main()